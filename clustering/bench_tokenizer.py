@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark for the tokenization of the lyrics used in the clustering of songs
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+import argparse
+import os
+import sys
+
+from itertools import islice
+from time import time
+
+from clusmodels import Tokenizer
+from clusongs import process_text, tokenize_corpus
+from spoting.corpus import iter_songs
+
+
+def get_params():
+    parser = argparse.ArgumentParser(usage="usage: bench_tokenizer.py [options]",
+                                     description="Compare the lyrics tokenizers using a songs dataset")
+    parser.add_argument('-d', '--dataset', required=True, help="File path with the songs")
+    parser.add_argument('-n', '--songs', type=int, default=0, help="Max number of songs to use (all by default)")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help="Number of processes used by the parallel tokenizer")
+
+    return parser.parse_args()
+
+
+def bench(tokenize, texts):
+    """
+    Time a tokenizer
+
+    :param tokenize: function to tokenize a list of texts
+    :param texts: list with the texts
+    :return: the total seconds and the tokens of each text
+    """
+
+    task_init = time()
+    tokens = tokenize(texts)
+
+    return time() - task_init, tokens
+
+
+if __name__ == '__main__':
+
+    args = get_params()
+
+    songs = iter_songs(args.dataset, fields=['lyrics'])
+    if args.songs:
+        songs = islice(songs, args.songs)
+    # The vectorizer lowercases the texts before tokenizing them
+    texts = [song['lyrics'].lower() for song in songs if song['lyrics']]
+    print("Lyrics read: %i (%i chars)" % (len(texts), sum(len(text) for text in texts)))
+
+    process_time, process_tokens = bench(lambda texts: [process_text(text) for text in texts], texts)
+    tokenizer_time, tokenizer_tokens = bench(lambda texts: [Tokenizer()(text) for text in texts], texts)
+    cached_time, cached_tokens = bench(lambda texts: tokenize_corpus(texts, workers=1), texts)
+    parallel_time, parallel_tokens = bench(lambda texts: tokenize_corpus(texts, workers=args.workers), texts)
+
+    different = [tokens for tokens in (tokenizer_tokens, cached_tokens, parallel_tokens) if tokens != process_tokens]
+    if different:
+        print("Different tokens generated by the tokenizers")
+
+    def report(name, seconds):
+        speedup = process_time / seconds if seconds else float('inf')
+        print("%-28s %0.3f sec (%0.2f ms per song) %0.1fx" %
+              (name, seconds, 1000 * seconds / max(len(texts), 1), speedup))
+
+    report("process_text:", process_time)
+    report("Tokenizer per song:", tokenizer_time)
+    report("Tokenizer with stems cache:", cached_time)
+    report("Tokenizer %i processes:" % args.workers, parallel_time)
+
+    if different:
+        sys.exit(1)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alberto Pérez García-Plaza <alpgarcia@bitergia.com>
+#   Alvaro del Castillo <acs@bitergia.com>
+#
+import functools
+import pickle
+import string
+
+import numpy
+
+from nltk import word_tokenize, PorterStemmer
+from nltk.corpus import stopwords
+from scipy.sparse import diags
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+TFIDF_MAX_DF = 0.5  # Words in more than this ratio of the songs are ignored
+TFIDF_MIN_DF = 0.1  # Words in less than this ratio of the songs are ignored
+HASHING_FEATURES = 2 ** 18  # Columns of the hashing vectorizer
+STEMS_CACHE_SIZE = 100000  # Max number of words with the stem cached
+
+
+class Tokenizer():
+    """
+    Tokenize texts and stem words removing punctuation, like clusongs.process_text
+
+    The punctuation table and the stemmer are built only once, and the stems
+    of the words are cached as the vocabulary of the lyrics is very repeated.
+    Tokenizers can be pickled so they can be sent to other processes.
+    """
+
+    def __init__(self, stem=True, stop_words=None, cache_size=STEMS_CACHE_SIZE):
+        """
+        :param stem: if True the tokens are stemmed
+        :param stop_words: words removed after stemming, like TfidfVectorizer does
+        :param cache_size: max number of words with the stem cached
+        """
+        self.stem = stem
+        self.stop_words = frozenset(stop_words) if stop_words else frozenset()
+        self.cache_size = cache_size
+
+        self.table = str.maketrans('', '', string.punctuation)
+        self.stemmer = PorterStemmer()
+        self.stem_word = functools.lru_cache(maxsize=cache_size)(self.stemmer.stem)
+
+    def __call__(self, text):
+        tokens = word_tokenize(text.translate(self.table))
+
+        if self.stem:
+            tokens = [self.stem_word(t) for t in tokens]
+        if self.stop_words:
+            tokens = [t for t in tokens if t not in self.stop_words]
+
+        return tokens
+
+    def __getstate__(self):
+        # The stems cache is not sent, it is built again in each process
+        return {'stem': self.stem, 'stop_words': self.stop_words, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def tokens_analyzer(tokens):
+    """ Analyzer for texts already tokenized """
+    return tokens
+
+
+class ClusterModel():
+    """
+    Vectorizer and K-Means model fitted with a corpus of texts
+
+    It can be saved to a file to assign later new texts to the same clusters.
+    """
+
+    def __init__(self, vectorizer, km_model, tokenizer=None):
+        """
+        :param vectorizer: fitted vectorizer
+        :param km_model: fitted K-Means or mini-batch K-Means model
+        :param tokenizer: Tokenizer to apply to the texts before the vectorizer, if it works with tokens
+        """
+        self.vectorizer = vectorizer
+        self.km_model = km_model
+        self.tokenizer = tokenizer
+        self.distance = None  # Mean distance of the fitted texts to their centroids
+        self.labels_map = None  # K-Means label -> cluster id, to keep the ids of a previous fit
+
+    def vectorize(self, texts):
+        if self.tokenizer:
+            texts = [self.tokenizer(text.lower()) for text in texts]
+        return self.vectorizer.transform(texts)
+
+    def predict(self, texts):
+        """
+        Assign texts to the clusters
+
+        :param texts: list of texts
+        :return: the cluster of each text and the distance to its centroid
+        """
+
+        distances = self.km_model.transform(self.vectorize(texts))
+        labels = distances.argmin(axis=1)
+        distances = distances[numpy.arange(len(labels)), labels]
+
+        labels_map = getattr(self, 'labels_map', None)
+        if labels_map:
+            labels = numpy.array([labels_map[label] for label in labels], dtype=labels.dtype)
+
+        return labels, distances
+
+    def save(self, path):
+        with open(path, "wb") as fmodel:
+            pickle.dump(self, fmodel, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as fmodel:
+            return pickle.load(fmodel)
+
+
+class StreamingTfidf():
+    """
+    Tf-Idf vectorizer for texts streamed in chunks
+
+    The words are hashed to a fixed number of columns so no vocabulary is kept,
+    and the documents frequency is counted per column. The memory used does not
+    depend on the number of texts. The same max_df, min_df and stop words than
+    in cluster_texts are used, so the coordinates are comparable to the ones of
+    TfidfVectorizer except for the collisions in the hashes.
+    """
+
+    def __init__(self, n_features=HASHING_FEATURES, max_df=TFIDF_MAX_DF, min_df=TFIDF_MIN_DF):
+        self.n_features = n_features
+        self.max_df = max_df
+        self.min_df = min_df
+        self.hasher = HashingVectorizer(tokenizer=Tokenizer(stop_words=stopwords.words('english')),
+                                        n_features=n_features,
+                                        alternate_sign=False,
+                                        norm=None,
+                                        lowercase=True)
+        self.doc_freq = numpy.zeros(n_features, dtype=numpy.int64)
+        self.n_docs = 0
+        self.weights = None
+
+    def partial_fit(self, texts):
+        """ Count the documents frequency of the words in a chunk of texts """
+
+        counts = self.hasher.transform(texts)
+        self.doc_freq += numpy.bincount(counts.indices, minlength=self.n_features)
+        self.n_docs += counts.shape[0]
+        self.weights = None
+
+        return self
+
+    def transform(self, texts):
+        """ Tf-Idf coordinates of a chunk of texts, normalized with l2 """
+
+        if self.weights is None:
+            # Smoothed idf, like TfidfTransformer, and zero for the words out of max_df/min_df
+            idf = numpy.log((1 + self.n_docs) / (1 + self.doc_freq)) + 1
+            keep = (self.doc_freq <= self.max_df * self.n_docs) & (self.doc_freq >= self.min_df * self.n_docs)
+            self.weights = diags(numpy.where(keep, idf, 0))
+
+        return normalize(self.hasher.transform(texts) @ self.weights)
@@ -22,29 +22,132 @@
 #   Alvaro del Castillo <acs@bitergia.com>
 #
 import argparse
+import hashlib
 import json
+import os
 import string
+import sys
+import tempfile
 
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import count, islice
 from pprint import pprint
+from time import sleep, time
 
-from elasticsearch import helpers, Elasticsearch
+import numpy
 
-from nltk import word_tokenize, PorterStemmer, collections
+import elasticsearch
+
+from elasticsearch import Elasticsearch, TransportError
+
+from nltk import word_tokenize, PorterStemmer
 from nltk.corpus import stopwords
-from sklearn.cluster import KMeans
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
+
+# The models are pickled with the classes of clusmodels, so they can be loaded from other modules
+from clusmodels import (TFIDF_MAX_DF, TFIDF_MIN_DF, ClusterModel, StreamingTfidf, Tokenizer,
+                        tokens_analyzer)
+from spoting.corpus import CORPUS_EXTENSION, iter_songs
+
+try:
+    # elasticsearch >= 8 raises the HTTP errors as ApiError, which is not a TransportError
+    from elasticsearch import ApiError
+except ImportError:
+    ApiError = TransportError
+
+CLUSTERS = 10
+ENGINES = ['kmeans', 'minibatch']
+MINIBATCH_CHUNK_SIZE = 1000  # Songs vectorized and fitted at once by the minibatch engine
+MODES = ['fit', 'assign']
+INDEX_MODES = ['full', 'update']
+DRIFT_THRESHOLD = 1.2  # Max ratio between the distance to the centroids of the new songs and the fitted ones
+SILHOUETTE_SAMPLE_SIZE = 2000  # Songs used to compute the silhouette score in the sweeps
+SWEEP_RANDOM_STATE = 0  # Same initial centroids and sample for all the k values in a sweep
+BULK_CHUNK_SIZE = 500  # Max number of songs sent in each bulk request
+BULK_MAX_BYTES = 10 * 1024 * 1024  # Max size of each bulk request
+BULK_THREADS = 4  # Bulk requests sent at the same time
+BULK_MAX_RETRIES = 5  # Retries of the bulk requests and songs rejected with 429 Too Many Requests
+BULK_BACKOFF = 0.5  # Seconds to wait before the first retry, doubled in each one
+
+TOKENIZER_CHUNK_SIZE = 64  # Texts sent at once to each tokenizer process
+
+_worker_tokenizer = None  # Tokenizer used in each process of the tokenizer pool
+_worker_limits = None  # Limits of the native threads pools in each process of the sweep pool
 
 
 def get_params():
     parser = argparse.ArgumentParser(usage="usage: clusongs.py [options]",
                                      description="Automatic Clustering of songs")
-    parser.add_argument('-d', '--dataset', required=True, help="File path with the songs")
+    parser.add_argument('-d', '--dataset', required=True,
+                        help="File path with the songs: JSON array, JSON Lines (.jsonl) "
+                             "or columnar corpus (%s)" % CORPUS_EXTENSION)
     parser.add_argument('-e', '--elasticsearch_url', required=False, default='http://localhost:9200',
                         help="Elasticsearch URL")
     parser.add_argument('-i', '--elasticsearch_index', required=False, default='songs_clusters',
                         help="Elasticsearch index in which to store the results")
-
-    return parser.parse_args()
+    parser.add_argument('--index-mode', choices=INDEX_MODES, default='full',
+                        help="full uploads the complete songs, update only sends the cluster of the songs "
+                             "already uploaded whose cluster changed since the previous --assignments (default: full)")
+    parser.add_argument('--bulk-size', type=int, default=BULK_CHUNK_SIZE,
+                        help="Max number of songs in each bulk request (default: %i)" % BULK_CHUNK_SIZE)
+    parser.add_argument('--bulk-bytes', type=int, default=BULK_MAX_BYTES,
+                        help="Max bytes of each bulk request (default: %i)" % BULK_MAX_BYTES)
+    parser.add_argument('--bulk-threads', type=int, default=BULK_THREADS,
+                        help="Bulk requests sent at the same time (default: %i)" % BULK_THREADS)
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help="Number of processes used to tokenize the lyrics")
+    parser.add_argument('-k', '--clusters', type=int, default=CLUSTERS,
+                        help="Number of clusters (default: %i)" % CLUSTERS)
+    parser.add_argument('-s', '--sweep', type=parse_range, metavar='MIN-MAX',
+                        help="Evaluate the number of clusters from MIN to MAX and use the best one")
+    parser.add_argument('--sample-size', type=int, default=SILHOUETTE_SAMPLE_SIZE,
+                        help="Songs used to compute the silhouette score in the sweep (default: %i)"
+                             % SILHOUETTE_SAMPLE_SIZE)
+    parser.add_argument('--engine', choices=ENGINES, default='kmeans',
+                        help="Clustering engine: kmeans loads all the lyrics in memory, minibatch "
+                             "streams them in chunks for big datasets (default: kmeans)")
+    parser.add_argument('--chunk-size', type=int, default=MINIBATCH_CHUNK_SIZE,
+                        help="Songs per chunk in the minibatch engine (default: %i)" % MINIBATCH_CHUNK_SIZE)
+    parser.add_argument('--mode', choices=MODES, default='fit',
+                        help="fit the clusters with all the songs, or assign the new and changed songs "
+                             "to the clusters of a saved model (default: fit)")
+    parser.add_argument('-m', '--model', help="File in which the fitted model is saved, and from which it is loaded")
+    parser.add_argument('-a', '--assignments',
+                        help="JSON file with the cluster and lyrics hash of each song, updated in each run")
+    parser.add_argument('--drift-threshold', type=float, default=DRIFT_THRESHOLD,
+                        help="Ratio of the distance to the centroids from which a refit is recommended "
+                             "(default: %0.1f)" % DRIFT_THRESHOLD)
+
+    args = parser.parse_args()
+
+    if args.mode == 'assign' and not (args.model and args.assignments):
+        parser.error("assign mode needs the --model and the --assignments files")
+    if args.index_mode == 'update' and not args.assignments:
+        parser.error("update index mode needs the --assignments file of the previous run")
+    if args.sweep and (args.mode != 'fit' or args.engine != 'kmeans'):
+        parser.error("the sweep is only available in fit mode with the kmeans engine")
+
+    return args
+
+
+def parse_range(value):
+    """ Parse a MIN-MAX range of number of clusters """
+
+    try:
+        k_min, k_max = [int(k) for k in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a MIN-MAX range" % value)
+
+    if k_min < 2 or k_max < k_min:
+        raise argparse.ArgumentTypeError("%s is not a valid range, 2 clusters is the minimum" % value)
+
+    return range(k_min, k_max + 1)
 
 
 def process_text(text, stem=True):
@@ -60,51 +163,733 @@ def process_text(text, stem=True):
     return tokens
 
 
-def cluster_texts(texts, clusters=3):
-    """ Transform texts to Tf-Idf coordinates and cluster texts using K-Means """
-    vectorizer = TfidfVectorizer(tokenizer=process_text,
-                                 stop_words=stopwords.words('english'),
-                                 max_df=0.5,
-                                 min_df=0.1,
-                                 lowercase=True)
+def init_tokenizer_worker(tokenizer):
+    global _worker_tokenizer
 
-    tfidf_model = vectorizer.fit_transform(texts)
-    km_model = KMeans(n_clusters=clusters)
-    km_model.fit(tfidf_model)
+    _worker_tokenizer = tokenizer
+
+
+def tokenize_worker(text):
+    return _worker_tokenizer(text.lower())
+
+
+def tokenize_corpus(texts, tokenizer=None, workers=os.cpu_count(), chunk_size=TOKENIZER_CHUNK_SIZE):
+    """
+    Tokenize the texts in a pool of processes
+
+    The texts are lowercased before tokenizing them.
+
+    :param texts: iterable with the texts to tokenize
+    :param tokenizer: Tokenizer to use, a default Tokenizer if None
+    :param workers: number of processes in the pool
+    :param chunk_size: number of texts sent at once to each process
+    :return: a list with the tokens of each text
+    """
+
+    tokenizer = tokenizer if tokenizer else Tokenizer()
+
+    if workers <= 1:
+        return [tokenizer(text.lower()) for text in texts]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_tokenizer_worker,
+                             initargs=(tokenizer,)) as executor:
+        return list(executor.map(tokenize_worker, texts, chunksize=chunk_size))
 
-    clustering = collections.defaultdict(list)
 
-    for idx, label in enumerate(km_model.labels_):
+def group_labels(labels):
+    """
+    Group the positions of the texts by cluster
+
+    :param labels: iterable with the cluster of each text
+    :return: a dict with the positions of the texts in each cluster
+    """
+
+    clustering = defaultdict(list)
+
+    for idx, label in enumerate(labels):
         clustering[label].append(idx)
 
     return clustering
 
 
-def feed_songs(songs, es_url, es_index):
+def vectorize_texts(texts, workers=1):
+    """
+    Transform texts to Tf-Idf coordinates
+
+    :param texts: list of texts
+    :param workers: number of processes used to tokenize the texts
+    :return: the fitted vectorizer, the Tokenizer to apply before it (None if not needed) and the Tf-Idf matrix
+    """
+
+    tokenizer = None
+
+    if workers > 1:
+        # The texts are tokenized in parallel and then vectorized
+        tokenizer = Tokenizer(stop_words=stopwords.words('english'))
+        texts = tokenize_corpus(texts, tokenizer, workers)
+        vectorizer = TfidfVectorizer(analyzer=tokens_analyzer,
+                                     max_df=TFIDF_MAX_DF,
+                                     min_df=TFIDF_MIN_DF)
+    else:
+        vectorizer = TfidfVectorizer(tokenizer=Tokenizer(),
+                                     stop_words=stopwords.words('english'),
+                                     max_df=TFIDF_MAX_DF,
+                                     min_df=TFIDF_MIN_DF,
+                                     lowercase=True)
+
+    return vectorizer, tokenizer, vectorizer.fit_transform(texts)
+
+
+def fit_vectors(vectorizer, tokenizer, tfidf_model, clusters=3, km_model=None):
+    """
+    Fit a K-Means model with texts already vectorized
+
+    :param vectorizer: vectorizer fitted with the texts
+    :param tokenizer: Tokenizer to apply before the vectorizer, None if not needed
+    :param tfidf_model: Tf-Idf matrix of the texts
+    :param clusters: number of clusters
+    :param km_model: K-Means model already fitted with tfidf_model (i.e. in a sweep), None to fit a new one
+    :return: the ClusterModel and the cluster of each text
+    """
+
+    if km_model is None:
+        km_model = KMeans(n_clusters=clusters)
+        distances = km_model.fit_transform(tfidf_model)
+    else:
+        distances = km_model.transform(tfidf_model)
+
+    model = ClusterModel(vectorizer, km_model, tokenizer)
+    model.distance = float(distances[numpy.arange(len(km_model.labels_)), km_model.labels_].mean())
+
+    return model, km_model.labels_
+
+
+def fit_model(texts, clusters=3, workers=1):
+    """
+    Transform texts to Tf-Idf coordinates and fit a K-Means model
+
+    :param texts: list of texts to cluster
+    :param clusters: number of clusters
+    :param workers: number of processes used to tokenize the texts
+    :return: the ClusterModel and the cluster of each text
+    """
+
+    return fit_vectors(*vectorize_texts(texts, workers), clusters)
+
+
+def save_shared_matrix(matrix, directory):
+    """
+    Save the arrays of a sparse matrix to .npy files so they can be memory mapped
+
+    :param matrix: CSR matrix
+    :param directory: directory for the files
+    :return: the files and shape of the matrix, to load it with load_shared_matrix
+    """
+
+    files = {}
+    for name in ['data', 'indices', 'indptr']:
+        files[name] = os.path.join(directory, name + '.npy')
+        numpy.save(files[name], getattr(matrix, name))
+
+    return files, matrix.shape
+
+
+def load_shared_matrix(files, shape):
+    """
+    Load a sparse matrix saved with save_shared_matrix
+
+    The arrays are memory mapped copy-on-write, so all the processes share the
+    same pages instead of having a copy of the matrix, as long as they don't
+    write to them. They can't be mapped read only: sklearn needs writable arrays
+    to use them without a copy (KMeans with copy_x=False).
+    """
+
+    arrays = [numpy.load(files[name], mmap_mode='c') for name in ['data', 'indices', 'indptr']]
+
+    return csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def init_sweep_worker():
+    """ Use a single OpenMP/BLAS thread in each process of the sweep, the pool already uses all the cores """
+    global _worker_limits
+
+    _worker_limits = threadpool_limits(limits=1)
+
+
+def evaluate_clusters(matrix_files, shape, clusters, sample_size=SILHOUETTE_SAMPLE_SIZE):
+    """
+    Fit K-Means with a number of clusters and score the result
+
+    :param matrix_files: files of the shared Tf-Idf matrix
+    :param shape: shape of the matrix
+    :param clusters: number of clusters
+    :param sample_size: number of texts used to compute the silhouette score
+    :return: a dict with the clusters, the silhouette score, the inertia, the seconds spent and the fitted model
+    """
+
+    task_init = time()
+
+    tfidf_model = load_shared_matrix(matrix_files, shape)
+    # With copy_x=True the shared matrix would be copied to each process
+    km_model = KMeans(n_clusters=clusters, copy_x=False, random_state=SWEEP_RANDOM_STATE)
+    km_model.fit(tfidf_model)
+
+    sample_size = min(sample_size, shape[0])
+    try:
+        silhouette = silhouette_score(tfidf_model, km_model.labels_, sample_size=sample_size,
+                                      random_state=SWEEP_RANDOM_STATE)
+    except ValueError:
+        # All the texts in the sample are in the same cluster
+        silhouette = -1
+
+    return {"clusters": clusters, "silhouette": float(silhouette), "inertia": float(km_model.inertia_),
+            "seconds": time() - task_init, "model": km_model}
+
+
+def sweep_clusters(tfidf_model, clusters_range, workers=os.cpu_count(), sample_size=SILHOUETTE_SAMPLE_SIZE):
+    """
+    Evaluate a range of number of clusters in a pool of processes
+
+    The Tf-Idf matrix is computed once and shared with the processes
+    using memory mapped files. Each process fits with a single thread,
+    so the pool does not oversubscribe the cores.
+
+    :param tfidf_model: Tf-Idf matrix of the texts
+    :param clusters_range: numbers of clusters to evaluate
+    :param workers: number of processes in the pool
+    :param sample_size: number of texts used to compute the silhouette scores
+    :return: the number of clusters with the best silhouette score, the scores of all of them
+             and the K-Means model fitted with the best number of clusters
+    """
+
+    with tempfile.TemporaryDirectory(prefix='clusongs-') as matrix_dir:
+        matrix_files, shape = save_shared_matrix(tfidf_model.tocsr(), matrix_dir)
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(clusters_range)),
+                                 initializer=init_sweep_worker) as executor:
+            futures = [executor.submit(evaluate_clusters, matrix_files, shape, clusters, sample_size)
+                       for clusters in clusters_range]
+            scores = [future.result() for future in futures]
+
+    best = max(scores, key=lambda score: score['silhouette'])
+    best_model = best['model']
+    for score in scores:
+        del score['model']
+
+    return best['clusters'], scores, best_model
+
+
+def show_sweep(best_clusters, scores):
+    """ Print the scores of a sweep of number of clusters """
+
+    print("%8s %10s %12s %8s" % ("clusters", "silhouette", "inertia", "seconds"))
+    for score in scores:
+        chosen = "*" if score['clusters'] == best_clusters else ""
+        print("%8i %10.4f %12.2f %8.2f %s" % (score['clusters'], score['silhouette'], score['inertia'],
+                                              score['seconds'], chosen))
+    print("Chosen number of clusters: %i" % best_clusters)
+
+
+def cluster_texts(texts, clusters=3, workers=1):
+    """
+    Transform texts to Tf-Idf coordinates and cluster texts using K-Means
+
+    :param texts: list of texts to cluster
+    :param clusters: number of clusters
+    :param workers: number of processes used to tokenize the texts
+    :return: a dict with the positions of the texts in each cluster
+    """
+
+    return group_labels(fit_model(texts, clusters, workers)[1])
+
+
+def iter_chunks(items, chunk_size):
+    """ Split an iterable in lists of chunk_size items """
+
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def fit_model_minibatch(texts, clusters=3, chunk_size=MINIBATCH_CHUNK_SIZE):
+    """
+    Fit a mini-batch K-Means model with texts streamed in chunks
+
+    The texts are read three times: to count the documents frequency of
+    the words, to fit the centroids and to assign the clusters.
+
+    :param texts: function returning a new iterator of the texts to cluster each time it is called
+    :param clusters: number of clusters
+    :param chunk_size: number of texts vectorized and fitted at once
+    :return: the ClusterModel and the cluster of each text
+    """
+
+    vectorizer = StreamingTfidf()
+    for chunk in iter_chunks(texts(), chunk_size):
+        vectorizer.partial_fit(chunk)
+
+    km_model = MiniBatchKMeans(n_clusters=clusters, batch_size=chunk_size)
+    pending = []
+    for chunk in iter_chunks(texts(), chunk_size):
+        # The first fit needs at least one text for each cluster
+        pending += chunk
+        if len(pending) >= clusters:
+            km_model.partial_fit(vectorizer.transform(pending))
+            pending = []
+    if pending:
+        km_model.partial_fit(vectorizer.transform(pending))
+
+    model = ClusterModel(vectorizer, km_model)
+
+    labels = []
+    total_distance = 0
+    for chunk in iter_chunks(texts(), chunk_size):
+        chunk_labels, distances = model.predict(chunk)
+        labels.extend(chunk_labels)
+        total_distance += distances.sum()
+    model.distance = float(total_distance / len(labels)) if labels else 0
+
+    return model, labels
+
+
+def cluster_texts_minibatch(texts, clusters=3, chunk_size=MINIBATCH_CHUNK_SIZE):
+    """
+    Cluster texts streamed in chunks using mini-batch K-Means
+
+    :param texts: function returning a new iterator of the texts to cluster each time it is called
+    :param clusters: number of clusters
+    :param chunk_size: number of texts vectorized and fitted at once
+    :return: a dict with the positions of the texts in each cluster
+    """
+
+    return group_labels(fit_model_minibatch(texts, clusters, chunk_size)[1])
+
+
+def match_clusters(songs_clusters, previous):
+    """
+    Map the clusters of a new fit onto the cluster ids of the previous assignments
+
+    K-Means numbers the clusters in an arbitrary order in each fit, so the
+    same grouping can get different ids. Each new cluster gets the id of the
+    previous cluster sharing most songs with it (Hungarian matching of the
+    contingency table), and the new clusters left without one get unused ids.
+
+    :param songs_clusters: dict with the new cluster of each song id
+    :param previous: dict with the previous [cluster, lyrics hash] of each song id (as string)
+    :return: a dict with the cluster id for each new cluster
+    """
+
+    new_ids = sorted(set(songs_clusters.values()))
+    old_ids = sorted({assignment[0] for assignment in previous.values()})
+
+    if not old_ids:
+        return {cluster: cluster for cluster in new_ids}
+
+    new_pos = {cluster: pos for pos, cluster in enumerate(new_ids)}
+    old_pos = {cluster: pos for pos, cluster in enumerate(old_ids)}
+
+    contingency = numpy.zeros((len(new_ids), len(old_ids)), dtype=numpy.int64)
+    for song_id, cluster in songs_clusters.items():
+        assignment = previous.get(str(song_id))
+        if assignment:
+            contingency[new_pos[cluster], old_pos[assignment[0]]] += 1
+
+    rows, cols = linear_sum_assignment(contingency, maximize=True)
+    mapping = {new_ids[row]: old_ids[col] for row, col in zip(rows, cols)}
+
+    used = set(old_ids)
+    free_ids = (cluster_id for cluster_id in count() if cluster_id not in used)
+    for cluster in new_ids:
+        if cluster not in mapping:
+            mapping[cluster] = next(free_ids)
+
+    return mapping
+
+
+def lyrics_hash(lyrics):
+    """ Hash of the lyrics of a song, to detect the songs changed since they were assigned """
+
+    return hashlib.sha1((lyrics or '').encode('utf-8')).hexdigest()
+
+
+def read_assignments(path):
+    """
+    Read the songs assignments
+
+    :param path: JSON file with the assignments
+    :return: a dict with the song id as key and [cluster, lyrics hash] as value
+    """
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as fassignments:
+        return json.load(fassignments)
+
+
+def write_assignments(assignments, path):
+    """
+    Write the songs assignments, replacing the file once it is complete
+
+    :param assignments: dict with the song id as key and [cluster, lyrics hash] as value
+    :param path: JSON file for the assignments
+    :return: None
+    """
+
+    with open(path + ".tmp", "w") as fassignments:
+        json.dump(assignments, fassignments)
+    os.replace(path + ".tmp", path)
+
+
+def restore_assignments(assignments, previous, song_ids):
+    """
+    Restore the previous assignments of some songs, removing the ones without a previous assignment
+
+    :param assignments: dict with the new assignments, it is updated
+    :param previous: dict with the previous assignments
+    :param song_ids: ids (as string) of the songs to restore
+    :return: the updated assignments
+    """
+
+    for song_id in song_ids:
+        if song_id in previous:
+            assignments[song_id] = previous[song_id]
+        else:
+            assignments.pop(song_id, None)
+
+    return assignments
+
+
+def assign_songs(model, songs, assignments, chunk_size=MINIBATCH_CHUNK_SIZE):
+    """
+    Assign the new and changed songs to the clusters of a fitted model
+
+    :param model: fitted ClusterModel
+    :param songs: iterable with the songs (id and lyrics fields are used)
+    :param assignments: dict with the current assignments, it is updated
+    :param chunk_size: number of songs vectorized at once
+    :return: a dict with the new cluster of the assigned songs, and their mean distance to the centroids
+    """
+
+    def pending_songs():
+        for song in songs:
+            song_hash = lyrics_hash(song['lyrics'])
+            assignment = assignments.get(str(song['id']))
+            if not assignment or assignment[1] != song_hash:
+                yield song, song_hash
+
+    assigned = {}
+    total_distance = 0
+    for chunk in iter_chunks(pending_songs(), chunk_size):
+        labels, distances = model.predict([song['lyrics'] or '' for song, _ in chunk])
+        for (song, song_hash), label in zip(chunk, labels):
+            assignments[str(song['id'])] = [int(label), song_hash]
+            assigned[song['id']] = int(label)
+        total_distance += distances.sum()
+
+    distance = float(total_distance / len(assigned)) if assigned else 0
+
+    return assigned, distance
+
+
+def serialize_action(action):
+    """
+    Build the lines of a bulk request for an action
+
+    :param action: dict with _index, _id, _op_type (index by default) and _source or doc (for updates)
+    :return: the lines encoded in UTF-8
+    """
+
+    op_type = action.get('_op_type', 'index')
+    meta = {op_type: {"_index": action['_index'], "_id": action['_id']}}
+    source = {"doc": action['doc']} if op_type == 'update' else action['_source']
+
+    return (json.dumps(meta) + "\n" + json.dumps(source, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+def iter_bulk_chunks(actions, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES):
+    """
+    Split the actions in chunks of chunk_size actions and max_bytes
+
+    :param actions: iterable with the actions
+    :param chunk_size: max number of actions in a chunk
+    :param max_bytes: max bytes of a chunk, a bigger action goes alone in its chunk
+    :return: a generator of lists with the serialized actions
+    """
+
+    chunk = []
+    chunk_bytes = 0
+
+    for action in actions:
+        lines = serialize_action(action)
+        if chunk and (len(chunk) == chunk_size or chunk_bytes + len(lines) > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(lines)
+        chunk_bytes += len(lines)
+
+    if chunk:
+        yield chunk
+
+
+class BulkError(Exception):
+    """ Some of the actions sent to Elasticsearch in bulk requests failed """
+
+    def __init__(self, batches):
+        """
+        :param batches: list with the stats of each bulk request
+        """
+        self.batches = batches
+        errors = sum(stats['errors'] for stats in batches)
+        super().__init__("%i items failed in the bulk requests" % errors)
+
+
+def es_connection(es_url, threads=BULK_THREADS):
+    """
+    Connect to Elasticsearch with a connections pool for the bulk threads
+
+    Both the elasticsearch 7.x and 8.x clients are supported.
+
+    :param es_url: Elasticsearch URL
+    :param threads: number of bulk requests sent at the same time
+    :return: the Elasticsearch connection
+    """
+
+    if elasticsearch.VERSION[0] >= 8:
+        return Elasticsearch(es_url, request_timeout=100, connections_per_node=threads)
+
+    return Elasticsearch([es_url], timeout=100, maxsize=threads)
+
+
+def error_status(ex):
+    """ HTTP status of an Elasticsearch client error, None if there is no response """
+
+    meta = getattr(ex, 'meta', None)
+    status = getattr(meta, 'status', None)
+    if status is None:
+        status = getattr(ex, 'status_code', None)
+
+    return status if isinstance(status, int) else None
+
+
+def send_bulk(es_conn, chunk, max_retries=BULK_MAX_RETRIES):
+    """
+    Send a chunk of actions in a bulk request
+
+    The request is retried if it is rejected with 429 Too Many Requests,
+    and the same for the actions rejected with 429 inside the bulk response.
+
+    :param es_conn: Elasticsearch connection
+    :param chunk: list with the serialized actions
+    :param max_retries: max number of retries
+    :return: a dict with the stats of the chunk, including the ids of the failed actions
+    """
+
+    task_init = time()
+    stats = {"docs": len(chunk), "bytes": sum(len(lines) for lines in chunk), "retries": 0, "failed": []}
+
+    pending = chunk
+    while True:
+        try:
+            res = es_conn.bulk(body=b"".join(pending))
+        except (TransportError, ApiError) as ex:
+            if error_status(ex) != 429 or stats['retries'] == max_retries:
+                raise
+            sleep(BULK_BACKOFF * 2 ** stats['retries'])
+            stats['retries'] += 1
+            continue
+
+        rejected = []
+        for lines, item in zip(pending, res['items']):
+            result = list(item.values())[0]
+            if result['status'] == 429:
+                rejected.append((lines, result))
+            elif result['status'] >= 300:
+                stats['failed'].append(str(result.get('_id')))
+
+        if not rejected:
+            break
+        if stats['retries'] == max_retries:
+            stats['failed'] += [str(result.get('_id')) for _, result in rejected]
+            break
+
+        sleep(BULK_BACKOFF * 2 ** stats['retries'])
+        stats['retries'] += 1
+        pending = [lines for lines, _ in rejected]
+
+    stats['errors'] = len(stats['failed'])
+    stats['seconds'] = time() - task_init
+
+    return stats
+
+
+def feed_actions(es_conn, actions, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES,
+                 threads=BULK_THREADS, max_retries=BULK_MAX_RETRIES):
+    """
+    Send actions to Elasticsearch using bulk requests in parallel
+
+    The actions are consumed as the requests are sent: no more than two
+    chunks per thread are waiting to be sent, so a slow Elasticsearch
+    slows down the reading of the actions instead of filling the memory.
+
+    :param es_conn: Elasticsearch connection
+    :param actions: iterable with the actions
+    :param chunk_size: max number of actions in each request
+    :param max_bytes: max bytes of each request
+    :param threads: number of requests sent at the same time
+    :param max_retries: max number of retries of the requests rejected with 429
+    :return: a generator of the stats of each request, in the same order than the actions
+    """
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = deque()
+        for chunk in iter_bulk_chunks(actions, chunk_size, max_bytes):
+            if len(in_flight) >= 2 * threads:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(send_bulk, es_conn, chunk, max_retries))
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def feed_es(es_url, actions, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES, threads=BULK_THREADS):
+    """
+    Send actions to Elasticsearch and show a summary
+
+    All the actions are sent even if some of them fail, and then BulkError is raised.
+
+    :param es_url:  Elasticsearch URL
+    :param actions: iterable with the actions
+    :param chunk_size: max number of actions in each bulk request
+    :param max_bytes: max bytes of each bulk request
+    :param threads: number of bulk requests sent at the same time
+    :return: a list with the stats of each bulk request
+    """
+
+    es_conn = es_connection(es_url, threads)
+
+    task_init = time()
+    batches = []
+    for batch, stats in enumerate(feed_actions(es_conn, actions, chunk_size, max_bytes, threads)):
+        stats['batch'] = batch
+        batches.append(stats)
+
+    written = sum(stats['docs'] - stats['errors'] for stats in batches)
+    errors = sum(stats['errors'] for stats in batches)
+    sent_bytes = sum(stats['bytes'] for stats in batches)
+    print("Items written to Elasticsearch: %i (errors: %i, %i bulk requests, %0.1f MB, %0.2f sec)" %
+          (written, errors, len(batches), sent_bytes / (1024 * 1024), time() - task_init))
+
+    if errors:
+        raise BulkError(batches)
+
+    return batches
+
+
+def feed_songs(songs, es_url, es_index, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES,
+               threads=BULK_THREADS):
     """
     Feed the songs to a Elasticsearch index
 
-    :param songs:  JSON document with the list of songs to feed to Elasticsearch
+    :param songs:  iterable with the songs to feed to Elasticsearch
     :param es_url:  Elasticsearch URL
     :param es_index: Elasticsearch index
-    :return: True is all goes well
+    :param chunk_size: max number of songs in each bulk request
+    :param max_bytes: max bytes of each bulk request
+    :param threads: number of bulk requests sent at the same time
+    :return: a list with the stats of each bulk request
     """
 
-    es_conn = Elasticsearch([es_url], timeout=100)
-    docs = []
+    # The docs are built while they are uploaded so the songs are not all in memory
+    docs = ({
+        "_index": es_index,
+        "_id": item['id'],
+        "_source": item
+    } for item in songs)
 
     # Uploading info to the new ES
-    for item in songs:
-        item_id = item['id']
-        doc = {
-            "_index": es_index,
-            "_type": "item",
-            "_id": item_id,
-            "_source": item
-        }
-        docs.append(doc)
-    helpers.bulk(es_conn, docs)
-    print("Items written to Elasticsearch: " + str(len(docs)))
+    return feed_es(es_url, docs, chunk_size, max_bytes, threads)
+
+
+def cluster_actions(songs, songs_clusters, previous, es_index, counts=None):
+    """
+    Build the actions to update the clusters of the songs in the index
+
+    The songs uploaded in a previous run with the same lyrics only get a
+    partial update with the new cluster, and nothing if it has not changed.
+    The new songs and the ones with changed lyrics are uploaded complete.
+
+    :param songs: iterable with the songs
+    :param songs_clusters: dict with the cluster of each song id
+    :param previous: dict with the previous [cluster, lyrics hash] of each song id (as string)
+    :param es_index: Elasticsearch index
+    :param counts: dict in which the number of songs uploaded, updated and skipped are counted
+    :return: a generator of the actions
+    """
+
+    counts = counts if counts is not None else {}
+    for kind in ['uploaded', 'updated', 'skipped']:
+        counts.setdefault(kind, 0)
+
+    for song in songs:
+        if song['id'] not in songs_clusters:
+            continue
+        cluster = songs_clusters[song['id']]
+        assignment = previous.get(str(song['id']))
+
+        if not assignment or assignment[1] != lyrics_hash(song.get('lyrics')):
+            song['cluster'] = cluster
+            counts['uploaded'] += 1
+            yield {"_index": es_index, "_id": song['id'], "_source": song}
+        elif assignment[0] != cluster:
+            counts['updated'] += 1
+            yield {"_op_type": "update", "_index": es_index, "_id": song['id'], "doc": {"cluster": cluster}}
+        else:
+            counts['skipped'] += 1
+
+
+def update_clusters(songs, songs_clusters, previous, es_url, es_index, chunk_size=BULK_CHUNK_SIZE,
+                    max_bytes=BULK_MAX_BYTES, threads=BULK_THREADS):
+    """
+    Update the clusters of the songs in a Elasticsearch index, sending only the changes
+
+    :param songs:  iterable with the songs
+    :param songs_clusters: dict with the cluster of each song id
+    :param previous: dict with the previous [cluster, lyrics hash] of each song id (as string)
+    :param es_url:  Elasticsearch URL
+    :param es_index: Elasticsearch index
+    :param chunk_size: max number of songs in each bulk request
+    :param max_bytes: max bytes of each bulk request
+    :param threads: number of bulk requests sent at the same time
+    :return: a list with the stats of each bulk request
+    """
+
+    counts = {'uploaded': 0, 'updated': 0, 'skipped': 0}
+    try:
+        return feed_es(es_url, cluster_actions(songs, songs_clusters, previous, es_index, counts),
+                       chunk_size, max_bytes, threads)
+    finally:
+        print("Songs uploaded: %i, clusters updated: %i, unchanged skipped: %i" %
+              (counts['uploaded'], counts['updated'], counts['skipped']))
+
+
+def add_clusters(songs, songs_clusters):
+    """
+    Add the cluster to the songs which have one
+
+    :param songs: iterable with the songs
+    :param songs_clusters: dict with the cluster of each song id
+    :return: a generator of the songs with a cluster, with the cluster field
+    """
+
+    for song in songs:
+        if song['id'] in songs_clusters:
+            song['cluster'] = songs_clusters[song['id']]
+            yield song
 
 
 if __name__ == '__main__':
@@ -120,30 +905,104 @@ if __name__ == '__main__':
 
     args = get_params()
 
-    with open(args.dataset) as f:
-        songs_json = json.load(f)
-
-    lyrics = []
-    titles = []
-    for song in songs_json:
-        lyrics.append(song['lyrics'])
-        titles.append(song['title'])
-
-    print("Lyrics read: %i" % len(lyrics))
-
-    clusters = cluster_texts(lyrics, 10)
-
-    clusters_with_titles = {}
-    for cluster_id, song_pos_list in clusters.items():
-        cluster_song_list = []
-        for song_pos in song_pos_list:
-            cluster_song_list.append(titles[song_pos])
-            songs_json[song_pos]['cluster'] = int(cluster_id)
-
-        clusters_with_titles[cluster_id] = cluster_song_list
-
-    pprint(clusters_with_titles)
-
-    feed_songs(songs_json, args.elasticsearch_url, args.elasticsearch_index)
+    # Assignments of the previous run, they are replaced once the songs are uploaded
+    previous = read_assignments(args.assignments) if args.assignments else {}
+    assignments = None
+
+    if args.mode == 'assign':
+        model = ClusterModel.load(args.model)
+        assignments = dict(previous)
+
+        songs_clusters, distance = assign_songs(model, iter_songs(args.dataset, fields=['id', 'lyrics']),
+                                                assignments, args.chunk_size)
+        print("Songs assigned: %i" % len(songs_clusters))
+
+        if songs_clusters:
+            # The new songs are far from the centroids if they don't fit well in the clusters
+            drift = distance / model.distance if model.distance else float('inf')
+            print("Mean distance to the centroids: %0.4f (fitted songs: %0.4f, drift %0.2f)" %
+                  (distance, model.distance, drift))
+            if drift > args.drift_threshold:
+                print("Drift over %0.2f: a full refit with --mode fit is recommended" % args.drift_threshold)
+    else:
+        if args.engine == 'minibatch':
+            # The lyrics are streamed from the dataset each time they are needed
+            def lyrics():
+                return (song['lyrics'] for song in iter_songs(args.dataset, fields=['lyrics']))
+
+            songs = list(iter_songs(args.dataset, fields=['id', 'title']))
+            print("Songs read: %i" % len(songs))
+
+            model, labels = fit_model_minibatch(lyrics, args.clusters, args.chunk_size)
+        else:
+            # The songs are streamed keeping only the fields needed for clustering
+            lyrics = []
+            songs = []
+            for song in iter_songs(args.dataset, fields=['id', 'title', 'lyrics']):
+                lyrics.append(song.pop('lyrics'))
+                songs.append(song)
+
+            print("Lyrics read: %i" % len(lyrics))
+
+            vectorizer, tokenizer, tfidf_model = vectorize_texts(lyrics, args.workers)
+            del lyrics
+
+            n_clusters = args.clusters
+            km_model = None
+            if args.sweep:
+                sweep_init = time()
+                n_clusters, scores, km_model = sweep_clusters(tfidf_model, args.sweep, args.workers,
+                                                              args.sample_size)
+                show_sweep(n_clusters, scores)
+                print("Sweep done in %0.2f sec" % (time() - sweep_init))
+
+            # The model chosen in the sweep is reused, so the clusters uploaded are the scored ones
+            model, labels = fit_vectors(vectorizer, tokenizer, tfidf_model, n_clusters, km_model)
+            del tfidf_model
+
+        songs_clusters = {song['id']: int(label) for song, label in zip(songs, labels)}
+
+        if previous:
+            # Keep the cluster ids of the previous run so only the songs really moved are changed
+            labels_map = match_clusters(songs_clusters, previous)
+            model.labels_map = labels_map
+            songs_clusters = {song_id: labels_map[cluster] for song_id, cluster in songs_clusters.items()}
+
+        if args.model:
+            model.save(args.model)
+            print("Model saved to", args.model)
+
+        clusters_with_titles = defaultdict(list)
+        for song in songs:
+            clusters_with_titles[songs_clusters[song['id']]].append(song['title'])
+
+        pprint(dict(clusters_with_titles))
+
+        if args.assignments:
+            # The lyrics hashes are needed to detect the songs changed in the next assign runs
+            assignments = {str(song['id']): [songs_clusters[song['id']], lyrics_hash(song['lyrics'])]
+                           for song in iter_songs(args.dataset, fields=['id', 'lyrics'])}
+
+    # The complete songs are streamed again from the dataset to upload them
+    failed = set()
+    try:
+        if args.index_mode == 'update':
+            update_clusters(iter_songs(args.dataset), songs_clusters, previous,
+                            args.elasticsearch_url, args.elasticsearch_index,
+                            args.bulk_size, args.bulk_bytes, args.bulk_threads)
+        else:
+            feed_songs(add_clusters(iter_songs(args.dataset), songs_clusters),
+                       args.elasticsearch_url, args.elasticsearch_index,
+                       args.bulk_size, args.bulk_bytes, args.bulk_threads)
+    except BulkError as ex:
+        print("Error uploading the songs to Elasticsearch:", ex)
+        failed = {song_id for stats in ex.batches for song_id in stats['failed']}
+
+    if assignments is not None:
+        # The songs not uploaded keep their previous assignment, so the next run sends them again
+        write_assignments(restore_assignments(assignments, previous, failed), args.assignments)
+
+    if failed:
+        sys.exit(1)
 
     print("Songs with cluster information uploaded to", args.elasticsearch_url + "/" + args.elasticsearch_index)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Mock of the Elasticsearch bulk API to benchmark the feeding of songs offline
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+#
+# The documents received are counted and discarded. Usage:
+#
+#   ./mock_es.py --port 9201 --latency 0.05 --reject 0.01 --reject-requests 0.01 &
+#   ./clusongs.py -d songs.json -e http://localhost:9201
+#
+
+import argparse
+import json
+import random
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+ES_VERSION = "7.17.0"
+
+
+def get_params():
+    parser = argparse.ArgumentParser(usage="usage: mock_es.py [options]",
+                                     description="Mock of the Elasticsearch _bulk endpoint")
+    parser.add_argument('-p', '--port', type=int, default=9201, help="Port to listen on (default: 9201)")
+    parser.add_argument('-l', '--latency', type=float, default=0, help="Seconds to wait in each bulk request")
+    parser.add_argument('-r', '--reject', type=float, default=0,
+                        help="Ratio of documents rejected with 429 Too Many Requests")
+    parser.add_argument('-R', '--reject-requests', type=float, default=0,
+                        help="Ratio of bulk requests rejected with 429 Too Many Requests")
+
+    return parser.parse_args()
+
+
+class BulkStats():
+    """ Counters of the bulk requests received, shared by the server threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.requests_rejected = 0
+        self.actions = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.init = time()
+
+    def add(self, actions, rejected, size):
+        with self.lock:
+            self.requests += 1
+            self.actions += actions
+            self.rejected += rejected
+            self.bytes += size
+
+    def add_rejected_request(self):
+        with self.lock:
+            self.requests_rejected += 1
+
+    def show(self):
+        seconds = time() - self.init
+        print("Bulk requests: %i (rejected: %i), actions: %i, rejected: %i, %0.1f MB, %0.1f actions/sec" %
+              (self.requests, self.requests_rejected, self.actions, self.rejected, self.bytes / (1024 * 1024),
+               self.actions / seconds if seconds else 0))
+
+
+class MockESHandler(BaseHTTPRequestHandler):
+    """ Answer the requests the Elasticsearch client sends to feed documents """
+
+    protocol_version = "HTTP/1.1"
+    latency = 0
+    reject = 0
+    reject_requests = 0
+    stats = BulkStats()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        # Header checked by the Elasticsearch clients >= 7.14
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_json({})
+
+    def do_GET(self):
+        self.send_json({"name": "mock_es", "cluster_name": "mock_es", "tagline": "You Know, for Search",
+                        "version": {"number": ES_VERSION, "build_flavor": "default"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not self.path.split('?')[0].endswith('/_bulk'):
+            self.send_json({"error": "Only the _bulk endpoint is supported"}, 404)
+            return
+
+        if self.reject_requests and random.random() < self.reject_requests:
+            self.stats.add_rejected_request()
+            self.send_json({"error": {"type": "es_rejected_execution_exception",
+                                      "reason": "rejected execution of bulk request"}, "status": 429}, 429)
+            return
+
+        task_init = time()
+        lines = body.splitlines()
+        items = []
+        rejected = 0
+        pos = 0
+        while pos < len(lines):
+            if not lines[pos].strip():
+                pos += 1
+                continue
+            meta = json.loads(lines[pos])
+            op_type, target = list(meta.items())[0]
+            pos += 1 if op_type == 'delete' else 2
+
+            status = 201 if op_type in ['index', 'create'] else 200
+            if self.reject and random.random() < self.reject:
+                status = 429
+                rejected += 1
+            items.append({op_type: {"_index": target.get('_index'), "_id": target.get('_id'), "status": status}})
+
+        if self.latency:
+            sleep(self.latency)
+
+        self.stats.add(len(items), rejected, len(body))
+        self.send_json({"took": int((time() - task_init) * 1000), "errors": rejected > 0, "items": items})
+
+    # The elasticsearch 8.x client sends the bulk requests with PUT
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+
+    args = get_params()
+
+    MockESHandler.latency = args.latency
+    MockESHandler.reject = args.reject
+    MockESHandler.reject_requests = args.reject_requests
+
+    server = ThreadingHTTPServer(('localhost', args.port), MockESHandler)
+    print("Mock Elasticsearch listening on http://localhost:%i" % args.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        MockESHandler.stats.show()
@@ -23,11 +23,11 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import logging
 
-import time
-
+from spoting.metrics import flush_at_exit
 from spoting.spoting import (SPOTIFY_API, SPOTIFY_API_ME,
-                             collect_tokens, query_api,
+                             collect_tokens, query_api, paginate, iter_pages,
                              find_user_followed_artists, find_user_tops,
                              )
 
@@ -103,24 +103,31 @@ def search_artist_tracks(token, artist):
     :return: A tracks list
     """
 
-    tracks = []
-    offset = 0
-
     limit = 50
     max_items = limit * 5  # Max number of result items to retrieve
     # Maximum offset: 100.000.
-    while True:
-        time.sleep(0.1)
-        search_url = SPOTIFY_API + "/search?type=track&q=artist:%s&limit=%i&offset=%i" % (artist, limit, offset)
-        items = query_api(token, search_url)
-        if not items['tracks']['items'] or offset >= max_items:
-            break
-        tracks += items['tracks']['items']
-        offset += limit
+    search_url = SPOTIFY_API + "/search?type=track&q=artist:%s" % artist
+    tracks = paginate(token, search_url, limit=limit, max_items=max_items, key='tracks')
 
     return tracks
 
 
+def iter_artist_tracks(token, artist):
+    """
+    Iterate the tracks found for an artist as they are fetched
+
+    :param token: Auth token
+    :param artist: Name of the artist to be searched
+    :return: A tracks generator
+    """
+
+    limit = 50
+    max_items = limit * 5  # Max number of result items to retrieve
+    search_url = SPOTIFY_API + "/search?type=track&q=artist:%s" % artist
+
+    return iter_pages(token, search_url, limit=limit, max_items=max_items, key='tracks')
+
+
 def find_user_saved_tracks(token):
     """
     Get a list of the songs saved in the current Spotify user’s “Your Music” library.
@@ -129,28 +136,35 @@ def find_user_saved_tracks(token):
     :return: A tracks list
     """
 
-    tracks = []
-    offset = 0
-
     limit = 50
     max_items = limit * 10  # Max number of result items to retrieve
-    while True:
-        time.sleep(0.1)
-        saved_url = SPOTIFY_API_ME + "/tracks?limit=%i&offset=%i" % (limit, offset)
-        items = query_api(token, saved_url)
-        if not items['items'] or offset >= max_items:
-            break
-        tracks += items['items']
-        offset += limit
+    tracks = paginate(token, SPOTIFY_API_ME + "/tracks", limit=limit, max_items=max_items)
 
     return tracks
 
 
+def iter_user_saved_tracks(token):
+    """
+    Iterate the songs saved in the current Spotify user’s “Your Music” library as they are fetched
+
+    :param token: Auth token
+    :return: A tracks generator
+    """
+
+    limit = 50
+    max_items = limit * 10  # Max number of result items to retrieve
+
+    return iter_pages(token, SPOTIFY_API_ME + "/tracks", limit=limit, max_items=max_items)
+
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    flush_at_exit()
+
     token = collect_tokens(SPOTIFY_USER, SCOPES)
     show_artists(find_user_tops(token, kind='artists'), title="Top")
     show_artists(find_user_followed_artists(token), title="Followed")
     show_tracks(find_user_tops(token), title="Top")
     show_tracks(find_recently_played_tracks(token), title="Recently Played")
-    show_tracks(search_artist_tracks(token, "Mecano"))
-    show_tracks(find_user_saved_tracks(token))
+    show_tracks(iter_artist_tracks(token, "Mecano"))
+    show_tracks(iter_user_saved_tracks(token))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark for the extraction of the lyrics from Genius song pages
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+import argparse
+import sys
+
+from time import time
+
+from spoting.genius import extract_lyrics, extract_lyrics_soup
+
+
+def get_params():
+    parser = argparse.ArgumentParser(usage="usage: bench_scrap_lyrics.py [options] page [page ...]",
+                                     description="Compare the lyrics extraction engines using saved Genius song pages")
+    parser.add_argument('pages', nargs='+', help="Genius song pages saved to disk (i.e. curl -o song.html <song_url>)")
+    parser.add_argument('-r', '--repeat', type=int, default=10, help="Number of times to extract the lyrics of each page")
+
+    return parser.parse_args()
+
+
+def bench(extractor, pages, repeat):
+    """
+    Time an extraction engine
+
+    :param extractor: function to extract the lyrics from a page
+    :param pages: list with the HTML of the pages
+    :param repeat: number of times to extract the lyrics of each page
+    :return: the total seconds and the lyrics extracted in the last round
+    """
+
+    task_init = time()
+    for _ in range(repeat):
+        lyrics = [extractor(page) for page in pages]
+
+    return time() - task_init, lyrics
+
+
+if __name__ == '__main__':
+
+    args = get_params()
+
+    pages = []
+    for page_file in args.pages:
+        with open(page_file) as fpage:
+            pages.append(fpage.read())
+
+    soup_time, soup_lyrics = bench(extract_lyrics_soup, pages, args.repeat)
+    fast_time, fast_lyrics = bench(extract_lyrics, pages, args.repeat)
+
+    different = [page_file for page_file, soup, fast in zip(args.pages, soup_lyrics, fast_lyrics) if soup != fast]
+    for page_file in different:
+        print("Different lyrics extracted from", page_file)
+
+    extractions = len(pages) * args.repeat
+    print("BeautifulSoup: %0.3f sec (%0.2f ms per page)" % (soup_time, 1000 * soup_time / extractions))
+    print("Fast parser:   %0.3f sec (%0.2f ms per page)" % (fast_time, 1000 * fast_time / extractions))
+    print("Speedup: %0.1fx" % (soup_time / fast_time if fast_time else float('inf')))
+
+    if different:
+        sys.exit(1)
@@ -24,34 +24,187 @@
 #
 import argparse
 import json
+import logging
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
-import requests
+from spoting.corpus import CORPUS_EXTENSION, iter_json_lines, write_corpus
+from spoting.metrics import flush_at_exit
+from spoting.genius import build_genius_token, find_genius_artist, find_genius_artist_songs
+
+SYNC_SONGS = 50  # Number of songs written between each sync of the output file to disk
+ARTISTS_WORKERS = 4  # Number of artists collected at the same time in batch mode
 
-from spoting.genius import build_genius_token, find_genius_artist, find_genius_artist_songs, scrap_lyrics
 
 def get_params():
     parser = argparse.ArgumentParser(usage="usage: gelyrics.py [options]",
                                      description="Collect songs data for an artist")
-    parser.add_argument('-a', '--artist', required=True, help="Name of the artist to collect songs for")
+    artists = parser.add_mutually_exclusive_group(required=True)
+    artists.add_argument('-a', '--artist', help="Name of the artist to collect songs for")
+    artists.add_argument('-f', '--artists-file',
+                         help="File with the names of the artists to collect songs for, one per line ('-' for stdin)")
+    parser.add_argument('-w', '--workers', required=False, type=int, default=ARTISTS_WORKERS,
+                        help="Number of artists collected at the same time with --artists-file")
     parser.add_argument('-l', '--lyrics', required=False, action='store_true', help="Collect also the lyrics for the songs")
+    parser.add_argument('-r', '--resume', required=False, action='store_true',
+                        help="Continue a previous collection skipping the songs already in the output file")
+    parser.add_argument('-c', '--compact', required=False, action='store_true',
+                        help="Convert at the end the JSON Lines output to a JSON array file (<artist>_songs.json)")
+    parser.add_argument('--format', required=False, choices=['json', 'arrow'], default='json',
+                        help="Format of the compacted file: JSON array or columnar corpus (<artist>_songs.arrow)")
 
     return parser.parse_args()
 
-if __name__ == '__main__':
 
-    task_init = time()
+class SongsWriter():
+    """
+    Append songs to a JSON Lines file, one song per line
 
-    args = get_params()
+    The file is synced to disk every sync_songs songs, so if the
+    collection is interrupted only the last songs are lost.
+    """
 
-    artist = args.artist
-    lyrics = True if args.lyrics else False
+    def __init__(self, path, resume=False, sync_songs=SYNC_SONGS):
+        """
+        :param path: JSON Lines file to write the songs to
+        :param resume: if True keep the songs already in the file
+        :param sync_songs: number of songs written between syncs to disk
+        """
+        self.path = path
+        self.sync_songs = sync_songs
+        self.songs_ids = set()
+        self.total_songs = 0
+
+        if resume and os.path.isfile(path):
+            self.songs_ids = self.read_songs_ids()
+            self.file = open(path, "a", encoding="utf-8")
+        else:
+            self.file = open(path, "w", encoding="utf-8")
+
+    def read_songs_ids(self):
+        """
+        Read the ids of the songs already in the file
+
+        A last line not completely written (the collection was interrupted) is removed.
+
+        :return: a set with the songs ids
+        """
+
+        songs_ids = set()
+        valid_size = 0
+
+        with open(self.path, "rb") as fsongs:
+            for line in fsongs:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    songs_ids.add(json.loads(line)['id'])
+                except ValueError:
+                    break
+                valid_size += len(line)
+
+        if valid_size < os.path.getsize(self.path):
+            print("Removing the last incomplete song from", self.path)
+            os.truncate(self.path, valid_size)
+
+        return songs_ids
+
+    def write(self, song):
+        self.file.write(json.dumps(song, ensure_ascii=False) + "\n")
+        self.songs_ids.add(song['id'])
+        self.total_songs += 1
+
+        if self.total_songs % self.sync_songs == 0:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def compact_songs(jsonl_path, output_path, output_format='json'):
+    """
+    Convert a JSON Lines songs file to a JSON array file or a columnar corpus, the formats used by clusongs
+
+    The songs are converted one by one so they are not all loaded in memory.
+
+    :param jsonl_path: JSON Lines file with the songs
+    :param output_path: file to write the songs to
+    :param output_format: json for a JSON array file, arrow for a columnar corpus
+    :return: the number of songs converted
+    """
+
+    if output_format == 'arrow':
+        return write_corpus(iter_json_lines(jsonl_path), output_path)
 
     total_songs = 0
 
-    # Get the Genius token
-    token = build_genius_token()
+    with open(output_path, "w", encoding="utf-8") as fjson:
+        fjson.write("[")
+        for song in iter_json_lines(jsonl_path):
+            fjson.write(",\n" if total_songs else "\n")
+            fjson.write(json.dumps(song, indent=True, ensure_ascii=False))
+            total_songs += 1
+        fjson.write("\n]")
+
+    return total_songs
+
+
+def read_artists(artists_file):
+    """
+    Read the artists names from a file, one per line
+
+    :param artists_file: path of the file, '-' to read them from stdin
+    :return: a list with the artists names, without duplicates
+    """
+
+    if artists_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(artists_file, encoding="utf-8") as fartists:
+            lines = fartists.readlines()
+
+    artists = []
+    for line in lines:
+        artist = line.strip()
+        if artist and artist not in artists:
+            artists.append(artist)
+
+    return artists
+
+
+def songs_file_name(artist):
+    """ File in which to write the songs for an artist """
+    return artist.replace(os.sep, "_") + "_songs.jsonl"
+
+
+def collect_artist(token, artist, lyrics=False, resume=False, compact=False, compact_format='json'):
+    """
+    Collect the songs for an artist and write them to its own file
+
+    :param token: Genius user token
+    :param artist: name of the artist
+    :param lyrics: if True collect also the lyrics for the songs
+    :param resume: if True skip the songs already in the artist file
+    :param compact: if True convert at the end the artist file to a JSON array file or a columnar corpus
+    :param compact_format: json for a JSON array file, arrow for a columnar corpus
+    :return: a dict with the number of songs and lyrics collected and the seconds spent
+    """
+
+    task_init = time()
+    stats = {"artist": artist, "songs": 0, "lyrics": 0, "time": 0}
 
     print("Finding the lyrics for", artist)
 
@@ -60,26 +213,102 @@ if __name__ == '__main__':
 
     if not artist_id:
         print("Can not find %s in Genius" % artist)
-        sys.exit(1)
+        return None
+
+    songs_file = songs_file_name(artist)
+
+    with SongsWriter(songs_file, resume=resume) as writer:
+        if writer.songs_ids:
+            print("%s: resuming the collection with %i songs already collected" % (artist, len(writer.songs_ids)))
+
+        # Get the songs for this artists and the lyrics for them
+        for song in find_genius_artist_songs(token, artist_id, lyrics=lyrics, unique=True, skip_ids=writer.songs_ids):
+            print("%s: new song found %s" % (artist, song['title']))
+            writer.write(song)
+            stats['songs'] += 1
+            if song.get('lyrics'):
+                stats['lyrics'] += 1
+
+    if compact:
+        extension = CORPUS_EXTENSION if compact_format == 'arrow' else ".json"
+        compact_file = songs_file[:-len(".jsonl")] + extension
+        compacted = compact_songs(songs_file, compact_file, compact_format)
+        print("%s: %i songs written to %s" % (artist, compacted, compact_file))
+
+    stats['time'] = time() - task_init
+    show_stats(stats)
+
+    return stats
+
+
+def collect_artist_safe(token, artist, *args):
+    """
+    Collect the songs for an artist like collect_artist, without raising the errors
+
+    In batch mode an artist failing must not stop the collection of the rest of them.
+
+    :return: the stats from collect_artist, None if the artist is not found and
+             a dict with the artist and the error if the collection failed
+    """
 
-    songs_with_lyrics = []
+    try:
+        return collect_artist(token, artist, *args)
+    except Exception as ex:
+        print("%s: collection failed, %s: %s" % (artist, type(ex).__name__, ex))
+        return {"artist": artist, "error": "%s: %s" % (type(ex).__name__, ex)}
 
-    # Get the songs for this artists and the lyrics for them
-    for song in find_genius_artist_songs(token, artist_id, lyrics=lyrics, unique=True):
-        print("New song found", song['title'])
-        songs_with_lyrics.append(song)
 
-        # Write the file after each 50 songs so if there are problems we don't loose data
-        if total_songs % 50 == 0:
-            with open(artist+"_songs.json", "w") as fsongs:
-                json.dump(songs_with_lyrics, fsongs, indent=True, ensure_ascii=False)
+def show_stats(stats):
+    """ Print the number of songs and lyrics collected and the throughput """
 
-        total_songs += 1
+    print("%s: %i songs and %i lyrics collected in %0.3f sec (%0.2f songs/sec, %0.2f lyrics/sec)" %
+          (stats['artist'], stats['songs'], stats['lyrics'], stats['time'],
+           stats['songs'] / stats['time'] if stats['time'] else 0,
+           stats['lyrics'] / stats['time'] if stats['time'] else 0))
 
-    # Write all songs to a file
-    with open(artist+"_songs.json", "w") as fsongs:
-            json.dump(songs_with_lyrics, fsongs, indent=True, ensure_ascii=False)
 
+if __name__ == '__main__':
+
+    task_init = time()
+
+    args = get_params()
 
-    print("%i songs collected in %0.3f sec" % (total_songs, time() - task_init))
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    flush_at_exit()
 
+    lyrics = True if args.lyrics else False
+
+    # Get the Genius token
+    token = build_genius_token()
+
+    if args.artist:
+        if not collect_artist(token, args.artist, lyrics, args.resume, args.compact, args.format):
+            sys.exit(1)
+        sys.exit(0)
+
+    # Batch mode: all the artists share the Genius client, so they share its rate limit
+    artists = read_artists(args.artists_file)
+    print("Collecting the songs for %i artists" % len(artists))
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        artists_stats = list(executor.map(lambda artist: collect_artist_safe(token, artist, lyrics, args.resume,
+                                                                             args.compact, args.format),
+                                          artists))
+
+    not_found = [artist for artist, stats in zip(artists, artists_stats) if not stats]
+    failed = [stats for stats in artists_stats if stats and 'error' in stats]
+    artists_stats = [stats for stats in artists_stats if stats and 'error' not in stats]
+
+    show_stats({"artist": "Total (%i artists)" % len(artists_stats),
+                "songs": sum([stats['songs'] for stats in artists_stats]),
+                "lyrics": sum([stats['lyrics'] for stats in artists_stats]),
+                "time": time() - task_init})
+
+    if not_found:
+        print("Artists not found in Genius:", ", ".join(not_found))
+
+    if failed:
+        print("Artists failed (collect them again with --resume):")
+        for stats in failed:
+            print("  %s: %s" % (stats['artist'], stats['error']))
+        sys.exit(1)
@@ -24,12 +24,14 @@
 #
 
 import json
+import logging
 import operator
 import os.path
 
 
+from spoting.metrics import flush_at_exit
 from spoting.spoting import (SPOTIFY_API, SPOTIFY_API_ME,
-                             collect_tokens, query_api,
+                             collect_tokens, query_api, paginate,
                              find_user_followed_artists, find_user_tops)
 
 DEBUG = False
@@ -191,23 +193,20 @@ def show_recommendations(new_artists):
     print(json.dumps(artists_followers_sorted, indent=True))
 
 
-def fetch_tracks_ids_from_playlist(playlist_id):
+def fetch_tracks_ids_from_playlist(token, playlist_id):
+    """
+    Get the ids of the tracks included in a playlist
 
-    url_playlist = SPOTIFY_API + "/users/%s/playlists/%s/tracks" % (SPOTIFY_USER, playlist_id)
+    :param token: User auth token
+    :param playlist_id: Id of the playlist
+    :return: a list of tracks ids
+    """
 
-    already_tracks_ids = []
+    url_playlist = SPOTIFY_API + "/users/%s/playlists/%s/tracks" % (SPOTIFY_USER, playlist_id)
 
     # Get the tracks that already exists to not duplicate data
-    already_tracks_ids = []
-    offset = 0
-    limit = 100
-    while True:
-        url_tracks = url_playlist + "?limit=%i&offset=%i" % (limit, offset)
-        tracks = query_api(token, url_tracks)
-        if not tracks['items']:
-            break
-        already_tracks_ids += [track['track']['id'] for track in tracks['items']]
-        offset += limit
+    tracks = paginate(token, url_playlist, limit=100)
+    already_tracks_ids = [track['track']['id'] for track in tracks if track['track']]
 
     return already_tracks_ids
 
@@ -259,7 +258,7 @@ def add_artists_top_track(token, playlist, artists):
 
     # To avoid adding duplicate tracks get the current ones
     print("Finding the tracks that are already in the playlist", playlist['name'])
-    already_tracks_ids = fetch_tracks_ids_from_playlist(playlist_id)
+    already_tracks_ids = fetch_tracks_ids_from_playlist(token, playlist_id)
 
     # Get first the tracks to be added to the playlist
     print("Finding the tracks to add to the playlist %s from %i artists (one call per each)"
@@ -301,18 +300,9 @@ def find_user_playlists(token):
     """
 
     # Check that the list does not exists yet
-    offset = 0
     max_items = 300
     limit = 20
-    playlists = []
-
-    while True:
-        playlists_url = SPOTIFY_API_ME + "/playlists?limit=%i&offset=%i" % (limit, offset)
-        playlists_res = query_api(token, playlists_url)
-        if not playlists_res['items'] or offset >= max_items:
-            break
-        playlists += playlists_res['items']
-        offset += limit
+    playlists = paginate(token, SPOTIFY_API_ME + "/playlists", limit=limit, max_items=max_items)
 
     return playlists
 
@@ -352,6 +342,9 @@ def create_playlist(token, name, description=""):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    flush_at_exit()
+
     token = collect_tokens(SPOTIFY_USER, SCOPES)
 
     # From all new artists select some of them using filters like genre, followers ...
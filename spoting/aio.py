@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# An experimental Spotify Playground
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+#
+# asyncio versions of the spoting.spoting queries
+#
+# The HTTP requests are sent by the shared SpotifyClient from a pool of threads,
+# so they use the same connections pool, rate limiter, retries and responses cache
+# than the synchronous API. Many queries can be awaited at the same time using
+# asyncio.gather, and run() can be used to call them from synchronous code:
+#
+#   tracks = run(find_user_playlist_tracks(token, playlist_id=playlist_id))
+#
+
+import asyncio
+import functools
+import threading
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+from spoting import spoting
+from spoting.spoting import (SPOTIFY_API, SPOTIFY_API_ME, MAX_IDS_ARTISTS, MAX_IDS_TRACKS,
+                             PAGINATION_WORKERS, build_playlist_url, get_client)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Get the pool of threads used to send the HTTP requests
+
+    There are as many threads as connections in the shared client pool.
+
+    :return: the shared ThreadPoolExecutor
+    """
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=get_client().pool_maxsize)
+
+    return _executor
+
+
+def run(coroutine):
+    """
+    Run a coroutine from synchronous code and return its result
+
+    :param coroutine: coroutine to run, i.e. find_user_playlists(token)
+    :return: the result of the coroutine
+    """
+    return asyncio.run(coroutine)
+
+
+async def query_api(token, url, method="GET", data=None):
+    """
+    Send a query to the Spotify API using the shared client
+
+    :param token: Auth token
+    :param url: URL for the endpoint we want to access
+    :param method: HTTP method to use (GET or POST)
+    :param data: body to send in POST requests
+    :return: The result in json format
+    """
+
+    loop = asyncio.get_running_loop()
+    query = functools.partial(spoting.query_api, token, url, method, data)
+
+    return await loop.run_in_executor(get_executor(), query)
+
+
+async def paginate(token, url, limit=50, max_items=0, key=None, workers=PAGINATION_WORKERS):
+    """
+    Get the items from an endpoint paginated with limit+offset
+
+    The first page is fetched to know the total number of items, and
+    then the rest of the pages are fetched concurrently.
+
+    :param token: Auth token
+    :param url: URL for the endpoint, without limit and offset params
+    :param limit: number of items per page
+    :param max_items: max number of items to return, 0 for all of them
+    :param key: field in the response with the paging object (i.e. 'tracks' in search), None if it is the response
+    :param workers: max number of pages fetched at the same time
+    :return: the items list in the order returned by the endpoint
+    """
+
+    if max_items and limit > max_items:
+        limit = max_items
+
+    semaphore = asyncio.Semaphore(workers)
+
+    async def fetch_page(offset):
+        page_url = url + ("&" if "?" in url else "?") + "limit=%i&offset=%i" % (limit, offset)
+        async with semaphore:
+            res = await query_api(token, page_url)
+        return res[key] if key else res
+
+    page = await fetch_page(0)
+    items = page['items']
+
+    total = page.get('total', len(items))
+    if max_items:
+        total = min(total, max_items)
+
+    offsets = range(len(items), total, limit) if items else []
+    # gather returns the pages in the same order than the offsets
+    for page in await asyncio.gather(*[fetch_page(offset) for offset in offsets]):
+        if not page['items']:
+            break
+        items += page['items']
+
+    if max_items:
+        items = items[:max_items]
+
+    return items
+
+
+async def find_user_profile(token):
+    """
+    Find the user profile
+
+    The profiles cache is shared with spoting.spoting.find_user_profile.
+
+    :param token: Auth token
+    :return: the user profile related to the auth token
+    """
+
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(get_executor(), spoting.find_user_profile, token)
+
+
+async def find_user_tops(token, kind='tracks'):
+    """
+    Find the top tracks or artists
+
+    :param token: Auth token
+    :return: A tracks or artists list
+    """
+
+    kinds = ['tracks', 'artists']
+
+    if kind not in kinds:
+        raise RuntimeError('Tops are only available for %s not for %s' % (kinds, kind))
+
+    top_url = SPOTIFY_API_ME + "/top/%s?limit=50" % kind
+    top = await query_api(token, top_url)
+
+    return top['items']
+
+
+async def find_user_followed_artists(token):
+    """
+    Find the artists a user is following
+
+    The pages are linked with a cursor so they are fetched one after the other.
+
+    :param token: Auth token
+    :return: An artists list
+    """
+
+    artists = []
+    after = ''
+
+    while True:
+        followed_url = SPOTIFY_API_ME + "/following?type=artist&limit=50"
+        if after:
+            followed_url += "&after=" + after
+        items = await query_api(token, followed_url)
+
+        artists += items['artists']['items']
+        after = items['artists']['cursors']['after']
+        if not after:
+            break
+
+    return artists
+
+
+async def fetch_items_from_ids(token, kind, items_ids, max_ids):
+    """
+    Fetch items using the Spotify endpoints for getting several items in a call
+
+    All the chunks of max_ids are fetched concurrently.
+
+    :param token: Auth token
+    :param kind: kind of the items (tracks, artists ...) used as endpoint in the API
+    :param items_ids: list of items ids
+    :param max_ids: max number of ids supported by the endpoint in a call
+    :return: an items list in the same order than items_ids, with None for the items not found
+    """
+
+    items_ids = list(items_ids)
+    items_urls = [SPOTIFY_API + "/%s?ids=%s" % (kind, ",".join(items_ids[offset:offset + max_ids]))
+                  for offset in range(0, len(items_ids), max_ids)]
+
+    items = []
+    for res in await asyncio.gather(*[query_api(token, items_url) for items_url in items_urls]):
+        items += res[kind]
+
+    return items
+
+
+async def fetch_playlists_from_ids(token, playlists_ids, user_id=None):
+    """
+    Fetch the playlists information given their ids and the user auth token
+
+    :param token: Auth token
+    :param playlists_ids: list of playlists ids
+    :param user_id: owner of the playlists, not needed to access them
+    :return: a playlist list in the same order than playlists_ids, with None for the playlists not found
+    """
+
+    async def fetch_playlist(playlist_id):
+        playlist_url = build_playlist_url(playlist_id, user_id)
+        try:
+            return await query_api(token, playlist_url)
+        except requests.HTTPError as ex:
+            if ex.response is None or ex.response.status_code != 404:
+                raise
+            return None
+
+    return list(await asyncio.gather(*[fetch_playlist(playlist_id) for playlist_id in playlists_ids]))
+
+
+async def find_user_playlists(token, max=0):
+    """
+    Find playlists from the current user
+
+    :param token: Auth token
+    :param max: max number of playlists to return
+    :return: All the user playlists
+    """
+
+    max_playlists = max if max else 1000  # safe limit
+
+    return await paginate(token, SPOTIFY_API_ME + "/playlists", limit=50, max_items=max_playlists)
+
+
+async def find_user_playlist_tracks(token, playlist=None, playlist_id=None, max=0, user_id=None):
+    """
+    Find all the tracks included in a playlist
+
+    :param token: Auth token
+    :param playlist: playlist spotify object from which to get the tracks
+    :param playlist_id: playlist id from which to get the tracks
+    :param max: max number of tracks to return
+    :param user_id: owner of the playlist, not needed to access it
+    :return: All the playlist tracks
+    """
+
+    max_tracks = max if max else 1000  # safe limit
+
+    if not playlist_id:
+        playlist_id = playlist['id']
+
+    tracks_url = build_playlist_url(playlist_id, user_id) + "/tracks"
+
+    return await paginate(token, tracks_url, limit=50, max_items=max_tracks)
+
+
+async def fetch_tracks_from_ids(token, tracks_ids):
+    """
+    Fetch the tracks information given their ids and the user auth token
+
+    :param token: Auth token
+    :param tracks_ids: list of track ids
+    :return: a tracks list in the same order than tracks_ids, with None for the tracks not found
+    """
+
+    return await fetch_items_from_ids(token, 'tracks', tracks_ids, MAX_IDS_TRACKS)
+
+
+async def fetch_artists_from_ids(token, artists_ids):
+    """
+    Fetch the artists information given their ids and the user auth token
+
+    :param token: Auth token
+    :param artists_ids: list of artist ids
+    :return: an artists list in the same order than artists_ids, with None for the artists not found
+    """
+
+    return await fetch_items_from_ids(token, 'artists', artists_ids, MAX_IDS_ARTISTS)
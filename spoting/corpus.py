@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# An experimental Spotify Playground
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+#
+# Columnar storage for songs corpora (lyrics datasets)
+#
+# Songs are stored in an Arrow IPC (Feather V2) file with a column for each of
+# the fields used to analyze them (id, title, url, lyrics) and a json column with
+# the complete Genius song object. Readers can load only the columns they need,
+# and the file is memory mapped so the pages not used are never read.
+#
+# Songs can also be streamed from the JSON array and JSON Lines files written by
+# gelyrics using iter_songs, so they are never all loaded in memory.
+#
+
+import json
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+CORPUS_EXTENSION = '.arrow'
+CORPUS_BATCH_SIZE = 1000  # Songs written in each record batch
+CORPUS_COMPRESSION = 'zstd'  # None to write an uncompressed file which can be read without copies
+JSON_CHUNK_SIZE = 64 * 1024  # Chars read at once when streaming a JSON array file
+JSON_SEPARATORS = ' \t\n\r,]'  # Chars that can follow an item in a JSON array
+
+
+def check_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is needed for the columnar songs corpus: pip install pyarrow")
+
+
+def corpus_schema():
+    """ Columns of the songs corpus """
+
+    check_pyarrow()
+
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('title', pyarrow.string()),
+        ('url', pyarrow.string()),
+        ('lyrics', pyarrow.string()),
+        ('json', pyarrow.string())
+    ])
+
+
+def write_corpus(songs, path, compression=CORPUS_COMPRESSION, batch_size=CORPUS_BATCH_SIZE):
+    """
+    Write songs to a columnar corpus file
+
+    The songs are written in batches so they don't need to be all in memory.
+
+    :param songs: iterable of Genius songs objects
+    :param path: file to write the corpus to
+    :param compression: compression for the columns (zstd, lz4) or None
+    :param batch_size: number of songs written in each batch
+    :return: the number of songs written
+    """
+
+    schema = corpus_schema()
+    options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+    total_songs = 0
+
+    def build_batch(batch):
+        columns = {
+            'id': [song['id'] for song in batch],
+            'title': [song.get('title') for song in batch],
+            'url': [song.get('url') for song in batch],
+            'lyrics': [song.get('lyrics') for song in batch],
+            'json': [json.dumps(song, ensure_ascii=False) for song in batch]
+        }
+        return pyarrow.RecordBatch.from_pydict(columns, schema=schema)
+
+    with pyarrow.ipc.new_file(path, schema, options=options) as writer:
+        batch = []
+        for song in songs:
+            batch.append(song)
+            if len(batch) == batch_size:
+                writer.write_batch(build_batch(batch))
+                total_songs += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(build_batch(batch))
+            total_songs += len(batch)
+
+    return total_songs
+
+
+def read_corpus(path, columns=None, memory_map=True):
+    """
+    Read the columns of a corpus file
+
+    :param path: corpus file
+    :param columns: list of columns to read (id, title, url, lyrics, json), all if None
+    :param memory_map: if True the file is memory mapped
+    :return: a pyarrow.Table with the columns
+    """
+
+    check_pyarrow()
+
+    return pyarrow.feather.read_table(path, columns=columns, memory_map=memory_map)
+
+
+def iter_corpus(path, columns=None):
+    """
+    Iterate the songs in a corpus file
+
+    If the json column is read the complete song object is returned,
+    if not a dict with the columns read.
+
+    :param path: corpus file
+    :param columns: list of columns to read (id, title, url, lyrics, json), all if None
+    :return: a generator of songs
+    """
+
+    table = read_corpus(path, columns)
+
+    for batch in table.to_batches():
+        rows = batch.to_pydict()
+        for pos in range(batch.num_rows):
+            if 'json' in rows:
+                yield json.loads(rows['json'][pos])
+            else:
+                yield {column: values[pos] for column, values in rows.items()}
+
+
+def iter_json_array(path, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Iterate the items of a JSON array file without loading all the file
+
+    :param path: JSON file with an array
+    :param chunk_size: chars read from the file at once
+    :return: a generator of the array items
+    """
+
+    decoder = json.JSONDecoder()
+
+    with open(path, encoding="utf-8") as fjson:
+        buffer = ""
+        pos = 0
+        started = False
+        eof = False
+
+        def read_more():
+            nonlocal buffer, pos, eof
+            more = fjson.read(chunk_size)
+            if not more:
+                eof = True
+            buffer, pos = buffer[pos:] + more, 0
+
+        while True:
+            # Skip the separators between items
+            while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')):
+                pos += 1
+
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError("Unexpected end of the JSON array in %s" % path)
+                read_more()
+                continue
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("%s does not include a JSON array" % path)
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The item is not complete in the buffer yet
+                if eof:
+                    raise
+                read_more()
+                continue
+
+            # A number cut at the end of the buffer is decoded without errors (23 from 23456),
+            # so the item is only complete if a separator follows it
+            if not eof and (end == len(buffer) or buffer[end] not in JSON_SEPARATORS):
+                read_more()
+                continue
+
+            yield item
+
+            pos = end
+            if pos > chunk_size:
+                buffer, pos = buffer[pos:], 0
+
+
+def iter_json_lines(path):
+    """
+    Iterate the items of a JSON Lines file
+
+    :param path: JSON Lines file
+    :return: a generator of the items
+    """
+
+    with open(path, encoding="utf-8") as fjson:
+        for line in fjson:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_songs(path, fields=None):
+    """
+    Stream the songs from a songs file
+
+    Supported formats: columnar corpus (.arrow), JSON Lines (.jsonl) and JSON array.
+
+    :param path: songs file
+    :param fields: list of fields to return for each song, all of them if None
+    :return: a generator of songs
+    """
+
+    if path.endswith(CORPUS_EXTENSION):
+        columns = fields if fields and set(fields) <= {'id', 'title', 'url', 'lyrics'} else ['json']
+        songs = iter_corpus(path, columns)
+    elif path.endswith('.jsonl'):
+        songs = iter_json_lines(path)
+    else:
+        songs = iter_json_array(path)
+
+    for song in songs:
+        if fields:
+            song = {field: song.get(field) for field in fields}
+        yield song
@@ -1,13 +1,147 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from difflib import SequenceMatcher
+from html.parser import HTMLParser
 from time import time
 
-import requests
-
 from bs4 import BeautifulSoup
 
+from spoting.metrics import METRICS
+from spoting.spoting import MAX_RETRIES, HttpClient, TokenBucket
+
 # GENIUS config
 GENIUS_API = "https://api.genius.com"
 TOKEN_FILE = ".token-genius"
 
+# Genius HTTP client config
+GENIUS_POOL_MAXSIZE = 20  # Max number of connections kept alive per host
+GENIUS_RATE_LIMIT = 10  # Requests per second allowed in average
+GENIUS_RATE_BURST = 10  # Max number of requests that can be sent at once
+GENIUS_WORKERS = 8  # Songs completed (full data and lyrics) at the same time
+GENIUS_PAGE_ENDPOINT = '/lyrics-page'  # Endpoint in the metrics for all the web pages fetched
+
+# Lyrics cache config
+LYRICS_CACHE_FILE = ".lyrics-cache.sqlite"
+LYRICS_CACHE_TTL = 30 * 24 * 3600  # Seconds the lyrics are reused before scrapping them again
+LYRICS_CACHE_MAX_SIZE = 500 * 1024 * 1024  # Max bytes of lyrics stored
+
+# Start of the div with the lyrics in the Genius song page: <div class="lyrics">
+LYRICS_DIV_RE = re.compile(r'<div\s[^>]*class\s*=\s*["\'](?:[^"\']*\s)?lyrics(?:\s[^"\']*)?["\'][^>]*>', re.IGNORECASE)
+LYRICS_PARSER_CHUNK = 8192  # Chars of the page fed to the parser at once
+
+# Songs titles suffixes for versions of the same song: "Song (Live)", "Song [Remix]", "Song - Remastered 2011"
+TITLE_SUFFIX_RE = re.compile(r'\s*(\([^()]*\)|\[[^\[\]]*\]|\s[-–—]\s[^-–—]*)$')
+# Only known version phrases are removed, so "Country Roads (Take Me Home)" is not the same song as "Country Roads"
+TITLE_VERSION_RE = re.compile(r'''
+    (live|acoustic|demo|instrumental|unplugged|mono|stereo)(\s(version|mix|recording))?(\s\d{4})?
+    | live\s(at|from|in|on)\s.+
+    | (radio|single|album|extended|original)\s(edit|version|mix)
+    | bonus\strack
+    | (\d{4}\s)?(digital(ly)?\s)?remaster(ed)?(\s\d{4})?(\sversion)?
+    | .*\bremix(ed)?
+    | (feat|ft)\.?\s.+ | featuring\s.+
+''', re.VERBOSE)
+TITLE_SUFFIX_CHARS = ' -–—()[]'  # Chars around the suffix text
+TITLE_PUNCTUATION_RE = re.compile(r'[\W_]+')
+
+
+class GeniusClient(HttpClient):
+    """
+    HTTP client for the Genius API and the Genius web pages
+
+    It shares a pool of keep-alive connections, a rate limiter and the
+    retries policy between all the Genius queries and lyrics scrapping.
+    """
+
+    service = 'genius'
+
+    def __init__(self, pool_maxsize=GENIUS_POOL_MAXSIZE, limiter=None, max_retries=MAX_RETRIES):
+        """
+        :param pool_maxsize: max number of connections kept alive per host
+        :param limiter: rate limiter to use, a new one with the Genius rate limit by default
+        :param max_retries: max number of retries for throttled (429) or failed (5xx) queries
+        """
+        limiter = limiter if limiter else TokenBucket(GENIUS_RATE_LIMIT, GENIUS_RATE_BURST)
+        super().__init__(pool_maxsize=pool_maxsize, limiter=limiter, max_retries=max_retries)
+        self.headers = {}  # token -> auth headers
+
+    def query(self, token, url):
+        """
+        Send a query to the Genius API
+
+        :param token: Genius user token
+        :param url: URL for the endpoint we want to access
+        :return: The result in json format
+        """
+
+        if token not in self.headers:
+            self.headers[token] = {"Authorization": "Bearer " + token}
+
+        res = self.send("GET", url, self.headers[token])
+        try:
+            res.raise_for_status()
+        except Exception:
+            print("Error in query to Genius API", res.reason, res.text)
+            raise
+
+        return res.json()
+
+    def fetch_page(self, url):
+        """
+        Fetch a Genius web page
+
+        :param url: URL of the page
+        :return: the HTML of the page
+        """
+
+        res = self.send("GET", url, {}, endpoint=GENIUS_PAGE_ENDPOINT)
+        try:
+            res.raise_for_status()
+        except Exception:
+            print("Error fetching Genius page", url, res.reason)
+            raise
+
+        return res.text
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_genius_client():
+    """
+    Get the Genius client shared by all the queries in the process
+
+    :return: the shared GeniusClient
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GeniusClient()
+                METRICS.add_collector(_client.export_pool_metrics)
+
+    return _client
+
+
+def query_genius(token, url):
+    """
+    Send a query to the Genius API using the shared client
+
+    :param token: Genius user token
+    :param url: URL for the endpoint we want to access
+    :return: The result in json format
+    """
+
+    return get_genius_client().query(token, url)
+
 
 def build_genius_token():
     """
@@ -23,23 +157,242 @@ def build_genius_token():
     return token
 
 
+class LyricsCache():
+    """
+    Store in a SQLite database the lyrics scrapped from Genius
+
+    Lyrics are keyed by the hash of the song URL. They expire after ttl
+    seconds, and the least recently used ones are removed when the size
+    of all the lyrics is bigger than max_size. The cache can be shared
+    between threads.
+    """
+
+    def __init__(self, path=LYRICS_CACHE_FILE, ttl=LYRICS_CACHE_TTL, max_size=LYRICS_CACHE_MAX_SIZE):
+        """
+        :param path: SQLite database file
+        :param ttl: seconds the lyrics are valid
+        :param max_size: max bytes of lyrics stored
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS lyrics (
+                               key TEXT PRIMARY KEY, url TEXT, lyrics TEXT, size INTEGER,
+                               fetched REAL, accessed REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS lyrics_accessed ON lyrics (accessed)")
+
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM lyrics").fetchone()[0]
+
+    @staticmethod
+    def build_key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get(self, url):
+        """
+        Get the lyrics for a song
+
+        :param url: Genius song URL
+        :return: the lyrics, None if they are not in the cache or expired
+        """
+
+        key = self.build_key(url)
+
+        with self.lock:
+            row = self.conn.execute("SELECT lyrics, size, fetched FROM lyrics WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+
+            lyrics, size, fetched = row
+            if time() - fetched > self.ttl:
+                self.conn.execute("DELETE FROM lyrics WHERE key = ?", (key,))
+                self.size -= size
+                return None
+
+            self.conn.execute("UPDATE lyrics SET accessed = ? WHERE key = ?", (time(), key))
+
+        return lyrics
+
+    def put(self, url, lyrics):
+        """
+        Store the lyrics for a song
+
+        :param url: Genius song URL
+        :param lyrics: lyrics for the song
+        :return: None
+        """
+
+        key = self.build_key(url)
+        size = len(lyrics.encode('utf-8'))
+
+        with self.lock:
+            row = self.conn.execute("SELECT size FROM lyrics WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, url, lyrics, size, time(), time()))
+            self.size += size - (row[0] if row else 0)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ Remove the least recently used lyrics until the size is under max_size """
+
+        removed = []
+        for key, size in self.conn.execute("SELECT key, size FROM lyrics ORDER BY accessed"):
+            if self.size <= self.max_size:
+                break
+            removed.append((key,))
+            self.size -= size
+
+        self.conn.executemany("DELETE FROM lyrics WHERE key = ?", removed)
+
+
+_lyrics_cache = None
+_lyrics_cache_enabled = True
+_lyrics_cache_lock = threading.Lock()
+
+
+def get_lyrics_cache():
+    """
+    Get the lyrics cache shared by the process
+
+    :return: the shared LyricsCache, None if the cache is disabled
+    """
+    global _lyrics_cache
+
+    if _lyrics_cache is None and _lyrics_cache_enabled:
+        with _lyrics_cache_lock:
+            if _lyrics_cache is None:
+                _lyrics_cache = LyricsCache()
+
+    return _lyrics_cache
+
+
+def configure_lyrics_cache(path=LYRICS_CACHE_FILE, ttl=LYRICS_CACHE_TTL, max_size=LYRICS_CACHE_MAX_SIZE):
+    """
+    Replace the shared lyrics cache with a new one
+
+    :param path: SQLite database file, None to disable the cache
+    :param ttl: seconds the lyrics are valid
+    :param max_size: max bytes of lyrics stored
+    :return: the new shared LyricsCache
+    """
+    global _lyrics_cache, _lyrics_cache_enabled
+
+    with _lyrics_cache_lock:
+        _lyrics_cache_enabled = path is not None
+        _lyrics_cache = LyricsCache(path, ttl, max_size) if path else None
+
+    return _lyrics_cache
+
+
+class LyricsParser(HTMLParser):
+    """
+    Collect the text inside the first div fed to the parser
+
+    It is fed with the page from the start of the lyrics div, and it is
+    done when that div is closed, so the rest of the page is not parsed.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0  # Number of divs open
+        self.skip = 0  # Number of script/style tags open
+        self.texts = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div':
+            self.depth += 1
+        elif tag in ['script', 'style']:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'div':
+            self.depth -= 1
+            if self.depth == 0:
+                self.done = True
+        elif tag in ['script', 'style'] and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if self.depth and not self.skip and not self.done:
+            self.texts.append(data)
+
+
+def extract_lyrics(page):
+    """
+    Extract the lyrics from a Genius song page without parsing all the page
+
+    :param page: HTML of the Genius song page
+    :return: the lyrics text, None if the lyrics div can not be found
+    """
+
+    match = LYRICS_DIV_RE.search(page)
+    if not match:
+        return None
+
+    parser = LyricsParser()
+    pos = match.start()
+    while not parser.done and pos < len(page):
+        parser.feed(page[pos:pos + LYRICS_PARSER_CHUNK])
+        pos += LYRICS_PARSER_CHUNK
+
+    if not parser.done:
+        # The lyrics div is not closed, the markup is not the expected one
+        return None
+
+    return "".join(parser.texts)
+
+
+def extract_lyrics_soup(page):
+    """
+    Extract the lyrics from a Genius song page parsing it with BeautifulSoup
+
+    :param page: HTML of the Genius song page
+    :return: the lyrics text
+    """
+
+    html = BeautifulSoup(page, "html.parser")  # Extract the page's HTML as a string
+    return html.find("div", class_="lyrics").get_text()
+
+
 def scrap_lyrics(lyrics_url):
     """
     Scrap the lyrics from Genius HTML lyrics song page. This scrapper must be changed
     when Genius changes the HTML included in the web lyrics song page.
 
+    The lyrics cache is checked before fetching the page.
+
     :param lyrics_url: Genius song URL
     :return: a string with the lyrics for the song
     """
-    page = requests.get(lyrics_url)
+
+    cache = get_lyrics_cache()
+    if cache:
+        lyrics = cache.get(lyrics_url)
+        if lyrics is not None:
+            METRICS.inc('cache_lookups_total', cache='lyrics', result='fresh')
+            return lyrics
+        METRICS.inc('cache_lookups_total', cache='lyrics', result='miss')
+
+    page = get_genius_client().fetch_page(lyrics_url)
 
     # Lyrics can not be accessed directly from the API
     # https://genius.com/discussions/277279-Get-the-lyrics-of-a-song
     # A URL is included with a web page with the lyrics
     # Scrapping it following: http://www.johnwmillr.com/scraping-genius-lyrics/
 
-    html = BeautifulSoup(page.text, "html.parser")  # Extract the page's HTML as a string
-    lyrics = html.find("div", class_="lyrics").get_text()
+    lyrics = extract_lyrics(page)
+    if lyrics is None:
+        METRICS.inc('genius_lyrics_fallback_total')
+        lyrics = extract_lyrics_soup(page)
+
+    if cache:
+        cache.put(lyrics_url, lyrics)
+
     return lyrics
 
 
@@ -63,6 +416,69 @@ def embed_lyrics(song_id, song_url, song_title, song_author):
 
     return embed_viewer
 
+
+def normalize_title(title):
+    """
+    Build a key for a song title so versions of the same song share it
+
+    Accents, case, punctuation and version suffixes (live, remix, remastered ...) are removed.
+
+    :param title: song title
+    :return: the normalized title
+    """
+
+    title = unicodedata.normalize('NFKD', title)
+    title = "".join([char for char in title if not unicodedata.combining(char)]).lower()
+
+    while True:
+        match = TITLE_SUFFIX_RE.search(title)
+        if not match or match.start() == 0 or not TITLE_VERSION_RE.fullmatch(match.group(1).strip(TITLE_SUFFIX_CHARS)):
+            break
+        title = title[:match.start()]
+
+    return TITLE_PUNCTUATION_RE.sub(' ', title).strip()
+
+
+class TitlesDeduplicator():
+    """
+    Detect duplicated songs using their normalized titles
+
+    If fuzzy is set, titles with a similarity ratio equal or higher
+    than it with an already seen title are also duplicated.
+    """
+
+    def __init__(self, fuzzy=0):
+        """
+        :param fuzzy: min similarity ratio (0-1) for near duplicated titles, 0 to disable it
+        """
+        self.fuzzy = fuzzy
+        self.keys = set()
+
+    def is_duplicated(self, title):
+        """
+        Check if a title is duplicated and register it if not
+
+        :param title: song title
+        :return: True if the title has already been seen
+        """
+
+        key = normalize_title(title)
+
+        if key in self.keys:
+            return True
+
+        if self.fuzzy:
+            for seen_key in self.keys:
+                matcher = SequenceMatcher(None, key, seen_key)
+                if matcher.real_quick_ratio() >= self.fuzzy and matcher.quick_ratio() >= self.fuzzy \
+                        and matcher.ratio() >= self.fuzzy:
+                    return True
+
+        self.keys.add(key)
+
+        return False
+
+
 def find_genius_artist(token, artist_name):
     """
 
@@ -74,9 +490,7 @@ def find_genius_artist(token, artist_name):
     artist_id = None
 
     url = GENIUS_API + "/search?q=" + artist_name
-    headers = {"Authorization": "Bearer " + token}
-    res = requests.get(url, headers=headers)
-    res_json = res.json()
+    res_json = query_genius(token, url)
 
     # Time to find the artist from all the results
     # Genius search for the artist_name in all places so some results
@@ -102,59 +516,96 @@ def find_genius_lyrics(token, song_name):
     """
 
     url = GENIUS_API + "/search?q=" + song_name
-    headers = {"Authorization": "Bearer " + token}
-    res = requests.get(url, headers=headers)
-    lyrics = res.json()
+    lyrics = query_genius(token, url)
 
     return lyrics
 
-def find_genius_artist_songs(token, artist_id, lyrics=True, unique=False, full=False):
+def find_genius_artist_songs(token, artist_id, lyrics=True, unique=False, full=False,
+                             workers=GENIUS_WORKERS, ordered=True, fuzzy=0, skip_ids=None):
     """
+    Find the songs of an artist
+
+    The full song data and the lyrics are collected by a pool of workers
+    while the songs listing pagination continues.
 
     :param token:  Genius user token
     :param artist_id: id of the artist to search songs for
     :param lyrics: if True include the lyrics in a new field in the song JSON
     :param unique: if True try to detect deuplicated songs and don't return them
     :param full: if True use the "song" API to get the full data for a song (including album for example)
-    :return: list of Genius songs objects
+    :param workers: number of songs completed (full data and lyrics) at the same time
+    :param ordered: if True songs are returned in the listing order, if False as soon as they are completed
+    :param fuzzy: with unique, min similarity ratio (0-1) for near duplicated titles, 0 to disable it
+    :param skip_ids: ids of the songs already collected, they are not completed nor returned
+    :return: generator of Genius songs objects
     """
 
-    songs_titles = []
-    page = 1
-    per_page = 50  # Max number per page
-
-    while True:
-        url = GENIUS_API + "/artists/%s/songs?per_page=%i&page=%i" % (artist_id, per_page, page)
-        headers = {"Authorization": "Bearer " + token}
-        res = requests.get(url, headers=headers)
-        res_json = res.json()
+    def list_songs():
+        # Duplicates are detected before completing the songs so their pages are never downloaded
+        titles = TitlesDeduplicator(fuzzy)
+        page = 1
+        per_page = 50  # Max number per page
 
-        songs = res_json['response']['songs']
+        while True:
+            url = GENIUS_API + "/artists/%s/songs?per_page=%i&page=%i" % (artist_id, per_page, page)
+            res_json = query_genius(token, url)
 
-        for song in songs:
-            if unique:
-                if song['title'].lower() in songs_titles:
+            for song in res_json['response']['songs']:
+                if unique and titles.is_duplicated(song['title']):
                     print("Not adding duplicated song:", song['title'])
                     continue
+                if skip_ids and song['id'] in skip_ids:
+                    continue
+                yield song
+
+            if 'next_page' in res_json['response'] and res_json['response']['next_page']:
+                page = res_json['response']['next_page']
+            else:
+                break
+
+    def complete_song(song):
+        if full:
+            url = GENIUS_API + "/songs/%s" % (song['id'])
+            song = query_genius(token, url)['response']['song']
+        if lyrics:
+            task_init = time()
+            song['lyrics'] = scrap_lyrics(song['url'])
+            elapsed = time() - task_init
+            METRICS.observe('genius_lyrics_seconds', elapsed)
+            print("%s: Total lyrics collecting time ... %0.3f sec" %
+                  (song['title'], elapsed))
+        return song
+
+    if not (full or lyrics):
+        yield from list_songs()
+        return
+
+    max_pending = workers * 2  # Songs waiting to be completed or returned
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for song in list_songs():
+                pending.append(executor.submit(complete_song, song))
+                if ordered:
+                    # Return the completed songs at the head without blocking the listing
+                    while pending and (pending[0].done() or len(pending) >= max_pending):
+                        yield pending.popleft().result()
                 else:
-                    songs_titles.append(song['title'].lower())
-            if full:
-                url = GENIUS_API + "/songs/%s" % (song['id'])
-                headers = {"Authorization": "Bearer " + token}
-                res = requests.get(url, headers=headers)
-                res_json = res.json()
-                song = res_json['response']['song']
-            if lyrics:
-                task_init = time()
-                song['lyrics'] = scrap_lyrics(song['url'])
-                print("%s: Total lyrics collecting time ... %0.3f sec" %
-                    (song['title'], time() - task_init))
-
-            yield song
-
-        if 'next_page' in res_json['response'] and res_json['response']['next_page']:
-            page = res_json['response']['next_page']
-        else:
-            break
-
-
+                    done, not_done = wait(pending, timeout=0 if len(pending) < max_pending else None,
+                                          return_when=FIRST_COMPLETED)
+                    pending = deque(not_done)
+                    for future in done:
+                        yield future.result()
+
+            if ordered:
+                while pending:
+                    yield pending.popleft().result()
+            else:
+                for future in as_completed(pending):
+                    yield future.result()
+                pending.clear()
+        finally:
+            # Don't wait for the songs not needed anymore
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# An experimental Spotify Playground
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+#
+# Metrics collected in the hot paths: HTTP requests latency, bytes, retries,
+# responses cache usage and the timings of the xpolyrics views and forms.
+#
+# All of them are stored in the process wide METRICS registry and they can be
+# exported using a sink:
+#
+#   METRICS.flush(PrometheusSink("metrics.prom"))
+#
+# Scripts call flush_at_exit() to export them when they finish, to the file in
+# the SPOTING_METRICS environment variable (.json or Prometheus text format)
+# or to the log if it is not defined.
+#
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Upper bounds (seconds) of the latency histograms buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS_ENV = 'SPOTING_METRICS'  # Environment variable with the file to export the metrics to
+
+# Path segments followed by an item id in the Spotify and Genius APIs
+ID_PARENTS = ['albums', 'artists', 'playlists', 'songs', 'tracks', 'users']
+
+logger = logging.getLogger(__name__)
+
+
+def endpoint_name(url):
+    """
+    Build the endpoint name for a URL replacing the ids in the path
+
+    i.e. https://api.spotify.com/v1/users/acs/playlists/37i9dQZF1DX/tracks?limit=50
+    is /users/{id}/playlists/{id}/tracks
+
+    :param url: URL of the request
+    :return: the endpoint name
+    """
+
+    segments = urlparse(url).path.strip('/').split('/')
+    if segments and segments[0] == 'v1':
+        segments = segments[1:]
+
+    endpoint = []
+    for segment in segments:
+        if endpoint and endpoint[-1] in ID_PARENTS:
+            segment = '{id}'
+        endpoint.append(segment)
+
+    return '/' + '/'.join(endpoint)
+
+
+class Histogram():
+    """ Distribution of observed values in fixed buckets """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is for values bigger than all buckets
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for pos, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                break
+        else:
+            pos = len(self.buckets)
+        self.counts[pos] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        :return: a list of (bucket upper bound, number of values lower or equal to it)
+        """
+
+        total = 0
+        cumulative = []
+        for bucket, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            cumulative.append((bucket, total))
+
+        return cumulative
+
+
+class Metrics():
+    """
+    Registry of counters, gauges and histograms, identified by a name and labels
+
+    It can be shared between threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.collectors = []  # functions called to update the gauges before a snapshot
+
+    @staticmethod
+    def build_labels(labels):
+        return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter
+
+        :param name: name of the counter
+        :param value: amount to add to the counter
+        :param labels: labels for the counter
+        :return: None
+        """
+
+        with self.lock:
+            self.counters[(name, self.build_labels(labels))] += value
+
+    def set(self, name, value, **labels):
+        """
+        Set the current value of a gauge
+
+        :param name: name of the gauge
+        :param value: current value
+        :param labels: labels for the gauge
+        :return: None
+        """
+
+        with self.lock:
+            self.gauges[(name, self.build_labels(labels))] = value
+
+    def add_collector(self, collector):
+        """
+        Register a function to be called before each snapshot, to set gauges with values
+        that are read only when the metrics are exported (i.e. connections pools stats)
+
+        :param collector: function without params
+        :return: None
+        """
+
+        with self.lock:
+            if collector not in self.collectors:
+                self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """
+        Unregister a function added with add_collector
+
+        :param collector: function to remove
+        :return: None
+        """
+
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram
+
+        :param name: name of the histogram
+        :param value: value observed
+        :param labels: labels for the histogram
+        :return: None
+        """
+
+        key = (name, self.build_labels(labels))
+
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observe in a histogram the seconds spent in a with block """
+
+        task_init = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - task_init, **labels)
+
+    def cache_hit_ratio(self, cache='spotify'):
+        """
+        Ratio of queries answered using the responses cache
+
+        :param cache: name of the cache
+        :return: the ratio, None if the cache has not been used
+        """
+
+        results = defaultdict(int)
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                labels = dict(labels)
+                if name == 'cache_lookups_total' and labels.get('cache') == cache:
+                    results[labels['result']] += value
+
+        lookups = sum(results.values())
+        if not lookups:
+            return None
+
+        return (lookups - results['miss']) / lookups
+
+    def snapshot(self):
+        """
+        Get the current values of all the metrics
+
+        :return: a dict with the counters, gauges and histograms
+        """
+
+        with self.lock:
+            collectors = list(self.collectors)
+        for collector in collectors:
+            collector()
+
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            gauges = [{"name": name, "labels": dict(labels), "value": value}
+                      for (name, labels), value in sorted(self.gauges.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": histogram.count,
+                           "sum": histogram.sum, "buckets": histogram.cumulative()}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def flush(self, sink=None):
+        """
+        Export the metrics to a sink
+
+        :param sink: sink to use, the one configured with set_sink by default
+        :return: what the sink returns
+        """
+
+        sink = sink if sink else _sink
+
+        return sink.emit(self)
+
+
+class LoggingSink():
+    """ Log a summary of the metrics """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def emit(self, metrics):
+        snapshot = metrics.snapshot()
+
+        for counter in snapshot['counters'] + snapshot['gauges']:
+            logger.log(self.level, "%s %s %s", counter['name'], counter['labels'], counter['value'])
+        for histogram in snapshot['histograms']:
+            mean = histogram['sum'] / histogram['count'] if histogram['count'] else 0
+            logger.log(self.level, "%s %s count=%i mean=%0.3f sec", histogram['name'],
+                       histogram['labels'], histogram['count'], mean)
+
+
+class JsonSink():
+    """ Dump the metrics to a JSON file """
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, metrics):
+        snapshot = metrics.snapshot()
+        snapshot['time'] = time.time()
+
+        for histogram in snapshot['histograms']:
+            histogram['buckets'] = [[str(bucket), count] for bucket, count in histogram['buckets']]
+
+        with open(self.path, "w") as fmetrics:
+            json.dump(snapshot, fmetrics, indent=True)
+
+
+class PrometheusSink():
+    """ Export the metrics in Prometheus text format, to a file if a path is given """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    @staticmethod
+    def format_labels(labels, extra=None):
+        labels = list(labels.items()) + (extra if extra else [])
+        if not labels:
+            return ''
+        values = ['%s="%s"' % (label, value.replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels]
+        return '{' + ','.join(values) + '}'
+
+    def render(self, metrics):
+        snapshot = metrics.snapshot()
+        lines = []
+        types_done = set()
+
+        for counter in snapshot['counters']:
+            if counter['name'] not in types_done:
+                lines.append("# TYPE %s counter" % counter['name'])
+                types_done.add(counter['name'])
+            lines.append("%s%s %s" % (counter['name'], self.format_labels(counter['labels']), counter['value']))
+
+        for gauge in snapshot['gauges']:
+            if gauge['name'] not in types_done:
+                lines.append("# TYPE %s gauge" % gauge['name'])
+                types_done.add(gauge['name'])
+            lines.append("%s%s %s" % (gauge['name'], self.format_labels(gauge['labels']), gauge['value']))
+
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in types_done:
+                lines.append("# TYPE %s histogram" % name)
+                types_done.add(name)
+            for bucket, count in histogram['buckets']:
+                le = '+Inf' if bucket == float('inf') else str(bucket)
+                lines.append("%s_bucket%s %i" % (name, self.format_labels(histogram['labels'], [('le', le)]), count))
+            lines.append("%s_sum%s %f" % (name, self.format_labels(histogram['labels']), histogram['sum']))
+            lines.append("%s_count%s %i" % (name, self.format_labels(histogram['labels']), histogram['count']))
+
+        return "\n".join(lines) + "\n"
+
+    def emit(self, metrics):
+        text = self.render(metrics)
+
+        if self.path:
+            with open(self.path, "w") as fmetrics:
+                fmetrics.write(text)
+
+        return text
+
+
+def sink_from_env():
+    """
+    Build the sink configured in the SPOTING_METRICS environment variable
+
+    :return: a JsonSink for .json files, a PrometheusSink for other files and a LoggingSink if it is not defined
+    """
+
+    path = os.environ.get(METRICS_ENV)
+
+    if not path:
+        return LoggingSink()
+    elif path.endswith('.json'):
+        return JsonSink(path)
+    else:
+        return PrometheusSink(path)
+
+
+METRICS = Metrics()
+
+_sink = sink_from_env()
+
+
+def set_sink(sink):
+    """
+    Configure the default sink used to flush the metrics
+
+    :param sink: LoggingSink, JsonSink, PrometheusSink or any object with an emit(metrics) method
+    :return: None
+    """
+    global _sink
+
+    _sink = sink
+
+
+def flush_at_exit(sink=None):
+    """
+    Export the metrics when the process finishes
+
+    :param sink: sink to use, the one configured with set_sink by default
+    :return: None
+    """
+
+    atexit.register(METRICS.flush, sink)
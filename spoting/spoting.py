@@ -23,23 +23,232 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import hashlib
+import itertools
 import json
 import os
+import random
+import threading
 import time
 
 import requests
 
 import spotipy.util as util
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from spotipy.oauth2 import SpotifyOAuth
+
+from spoting.metrics import METRICS, endpoint_name
+
 SPOTIFY_API = 'https://api.spotify.com/v1'
 SPOTIFY_API_ME = SPOTIFY_API + '/me'
 
 TOKEN_FILE = '.token'
+CREDENTIALS_FILE = 'app-credentials.json'
+
+# Access tokens expire after one hour. This expiry time is set on Spotify's side and can't be changed by the client
+TOKEN_TTL = 3600
+TOKEN_REFRESH_MARGIN = 300  # Seconds before the expiry in which the token is refreshed in background
+
+# HTTP connections pool config
+POOL_CONNECTIONS = 10  # Number of hosts to keep pools for
+POOL_MAXSIZE = 20  # Max number of connections kept alive per host
+
+# Rate limit config
+# Somewhere around 10-20 requests per second would put you in the correct ballpark
+RATE_LIMIT = 15  # Requests per second allowed in average
+RATE_BURST = 15  # Max number of requests that can be sent at once
+MAX_RETRIES = 5  # Max number of retries for a query throttled or failed
+RETRY_AFTER_DEFAULT = 1  # Seconds to wait if a 429 response does not include Retry-After
+BACKOFF_BASE = 0.5  # Seconds to wait before the first retry of a failed query
+BACKOFF_MAX = 30  # Max seconds to wait between retries of a failed query
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS']  # Methods retried after server and connection errors
+
+# Responses cache config
+CACHE_DIR = '.spoting-cache'
+CACHE_MAX_SIZE = 50 * 1024 * 1024  # Max bytes used by the cache in disk
+
+# Max number of ids that can be fetched in a single call
+MAX_IDS_TRACKS = 50
+MAX_IDS_ARTISTS = 50
+
+# Max number of pages fetched at the same time in paginated queries
+PAGINATION_WORKERS = 8
+# Number of pages fetched in background while the items of the current page are consumed
+PREFETCH_PAGES = 2
+
+# Seconds a user profile is reused before fetching it again
+PROFILE_TTL = 3600
 
-# TODO: Unify pagination with limit+offset when possible
 # TODO: Migrate to spotipy whenever possible
 
 
+_credentials_loaded = False
+_credentials_lock = threading.Lock()
+
+
+def load_credentials():
+    """ Configure the env for asking for tokens using the app credentials (only once) """
+    global _credentials_loaded
+
+    with _credentials_lock:
+        if not _credentials_loaded:
+            with open(CREDENTIALS_FILE) as file:
+                os.environ.update(json.load(file))
+            _credentials_loaded = True
+
+
+class TokenManager():
+    """
+    Keep in memory a valid token for a user and scopes
+
+    The token is refreshed in background when it is close to expire, so
+    getting it does not block the callers. The token is shared with other
+    processes using the token file: before asking Spotify for a new token
+    the file is checked in case other process already refreshed it.
+    """
+
+    def __init__(self, user, scopes, token_file=TOKEN_FILE, oauth=None):
+        """
+        :param user: Spotify user for getting the token
+        :param scopes: comma separated string list of scopes
+        :param token_file: file in which to share the token with other processes
+        :param oauth: SpotifyOAuth used to get the tokens (created from the app credentials if None)
+        """
+        self.user = user
+        self.scopes = scopes
+        self.token_file = token_file
+        self.oauth = oauth
+        self.current = (None, 0)  # (token, time in which it expires)
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def get(self):
+        """
+        Get a valid token
+
+        :return: a token for the user
+        """
+
+        token, expires_at = self.current
+        remaining = expires_at - time.time()
+
+        if token and remaining > TOKEN_REFRESH_MARGIN:
+            return token
+        elif token and remaining > 0:
+            self.refresh_background()
+            return token
+
+        # The token has expired (or there is no token yet) so callers must wait for a new one
+        with self.lock:
+            token, expires_at = self.current
+            if not token or expires_at <= time.time():
+                if not self.load():
+                    self.refresh()
+            return self.current[0]
+
+    def load(self):
+        """
+        Load the token from the token file if it is valid
+
+        :return: True if a valid token was loaded
+        """
+
+        try:
+            with open(self.token_file, "r") as ftoken:
+                token_info = json.load(ftoken)
+            token = token_info['access_token']
+            expires_at = token_info['expires_at']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        if not token or expires_at - time.time() <= TOKEN_REFRESH_MARGIN:
+            return False
+
+        self.set_token(token, expires_at)
+
+        return True
+
+    def get_oauth(self):
+        """ Get the SpotifyOAuth used to get the tokens """
+
+        if not self.oauth:
+            load_credentials()
+            self.oauth = SpotifyOAuth(scope=self.scopes, username=self.user)
+
+        return self.oauth
+
+    def refresh(self):
+        """ Ask Spotify for a new token and share it using the token file """
+
+        oauth = self.get_oauth()
+
+        print("Refreshing the token ... be patient")
+        # The cached token is returned as is until it expires, so it must
+        # be refreshed explicitly to get a new one before the current expires
+        token_info = oauth.get_cached_token()
+        if token_info and token_info.get('refresh_token'):
+            token_info = oauth.refresh_access_token(token_info['refresh_token'])
+        else:
+            util.prompt_for_user_token(self.user, self.scopes, oauth_manager=oauth)
+            token_info = oauth.get_cached_token()
+
+        token = token_info['access_token']
+        expires_at = token_info.get('expires_at', time.time() + TOKEN_TTL)
+
+        # Write it atomically so other processes never read a partial token
+        token_tmp = self.token_file + ".%i.tmp" % os.getpid()
+        with open(token_tmp, "w") as ftoken:
+            json.dump({"access_token": token, "expires_at": expires_at}, ftoken)
+        os.replace(token_tmp, self.token_file)
+
+        self.set_token(token, expires_at)
+
+    def refresh_background(self):
+        """ Refresh the token in a new thread if it is not already being refreshed """
+
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                with self.lock:
+                    if not self.load():
+                        self.refresh()
+            except Exception as ex:
+                print("Error refreshing the token in background", ex)
+            finally:
+                self.refresh_lock.release()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def set_token(self, token, expires_at):
+        get_client().register_user(token, self.user)
+        self.current = (token, expires_at)
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(user, scopes):
+    """
+    Get the token manager for a user and scopes shared by the process
+
+    :param user: Spotify user for getting the token
+    :param scopes: comma separated string list of scopes
+    :return: the TokenManager for them
+    """
+
+    with _token_managers_lock:
+        if (user, scopes) not in _token_managers:
+            _token_managers[(user, scopes)] = TokenManager(user, scopes)
+
+        return _token_managers[(user, scopes)]
+
+
 def collect_tokens(user, scopes):
     """
     Get a valid token for a user an a comma separated string list of scopes
@@ -49,76 +258,675 @@ def collect_tokens(user, scopes):
     :return: a token for this user
     """
 
-    # First step is to configure the env for asking for tokens
-    with open("app-credentials.json") as file:
-        os.environ.update(json.load(file))
+    return get_token_manager(user, scopes).get()
+
+
+class TokenBucket():
+    """
+    Token bucket rate limiter which can be shared between threads
+
+    Tokens are added at rate per second up to capacity, and each request
+    consumes one. When the server asks us to wait (429 Retry-After) the
+    bucket is emptied and closed until the wait is over.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, capacity=RATE_BURST):
+        """
+        :param rate: tokens added to the bucket per second
+        :param capacity: max number of tokens in the bucket
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait until a token is available and consume it """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Don't give tokens to anyone during some seconds
+
+        :param seconds: seconds to wait before giving tokens again
+        """
+
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.updated = self.blocked_until
+            self.tokens = 0
+
+
+_limiter = TokenBucket()
+
+
+def get_limiter():
+    """
+    Get the rate limiter shared by all the queries in the process
+
+    :return: the shared TokenBucket
+    """
+    return _limiter
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, max_delay=BACKOFF_MAX):
+    """
+    Exponential backoff with jitter for retrying failed queries
+
+    :param attempt: number of the retry, starting with 0
+    :param base: seconds to wait in the first retry
+    :param max_delay: max seconds to wait
+    :return: the seconds to wait before the retry
+    """
+
+    delay = min(max_delay, base * 2 ** attempt)
 
-    # Access tokens expire after one hour. This expiry time is set on Spotify's side and can't be changed by the client
-    # So we ask for a new token if we don't have a recent one
+    # Half of the delay is fixed and half random so clients don't retry at once
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_after_delay(response):
+    """
+    Get the seconds to wait from a throttled (429) response
 
-    refresh_token = False
+    :param response: the HTTP response
+    :return: the seconds to wait before sending new requests
+    """
 
     try:
-        # If tokens are older than 1h (3600s) we must refresh them
-        if int(time.time() - int(os.path.getmtime(TOKEN_FILE))) > 3600:
-            refresh_token = True
-    except Exception as ex:
-        refresh_token = True
+        return max(0, float(response.headers['Retry-After']))
+    except (KeyError, ValueError):
+        return RETRY_AFTER_DEFAULT
 
-    if refresh_token:
-        print("Refreshing the token ... be patient")
-        token = util.prompt_for_user_token(user, scopes)
-        with open(TOKEN_FILE, "w") as ftoken:
-            ftoken.write(token)
-    else:
-        with open(TOKEN_FILE, "r") as ftoken:
-            token = ftoken.read()
 
-    return token
+def cache_expiration(response):
+    """
+    Get until when a response can be used without asking the server again
+
+    :param response: the HTTP response
+    :return: the expiration time (epoch), None if the response must not be stored
+    """
+
+    max_age = 0
+
+    directives = [directive.strip().lower() for directive in response.headers.get('Cache-Control', '').split(',')]
+    for directive in directives:
+        if directive == 'no-store':
+            return None
+        elif directive.startswith('max-age='):
+            try:
+                max_age = int(directive[len('max-age='):])
+            except ValueError:
+                max_age = 0
+
+    if 'no-cache' in directives:
+        max_age = 0
+
+    return time.time() + max_age
+
+
+class ResponseCache():
+    """
+    Cache in disk for the Web API responses
+
+    Each entry is a JSON file with the ETag, the expiration time and the body
+    of a response, keyed by the URL and the user of the query. The files
+    modification time is used to track the least recently used entries, which
+    are removed when the size of the cache is bigger than max_size.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        """
+        :param cache_dir: directory in which to store the entries
+        :param max_size: max bytes used by the entries
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # entry key -> entry size, least recently used first
+        self.size = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        entries = []
+        for entry_file in os.listdir(self.cache_dir):
+            if not entry_file.endswith('.json'):
+                continue
+            entry_stat = os.stat(os.path.join(self.cache_dir, entry_file))
+            entries.append((entry_stat.st_mtime, entry_file[:-len('.json')], entry_stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.entries[key] = size
+            self.size += size
+
+    @staticmethod
+    def build_key(url, user):
+        return hashlib.sha1((user + ' ' + url).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, url, user):
+        """
+        Get the cached entry for a query
+
+        :param url: URL of the query
+        :param user: user sending the query
+        :return: a dict with the etag, expires and body fields, None if not cached
+        """
+
+        key = self.build_key(url, user)
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+
+        try:
+            with open(self.entry_path(key)) as fentry:
+                entry = json.load(fentry)
+            # The modification time persists the least recently used order
+            os.utime(self.entry_path(key))
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+
+        return entry
+
+    def put(self, url, user, etag, expires, body):
+        """
+        Store the response for a query
+
+        :param url: URL of the query
+        :param user: user sending the query
+        :param etag: ETag header of the response
+        :param expires: time (epoch) until the response can be used without asking the server
+        :param body: JSON body of the response
+        :return: None
+        """
+
+        key = self.build_key(url, user)
+        entry = json.dumps({"url": url, "etag": etag, "expires": expires, "body": body})
+
+        entry_tmp = self.entry_path(key) + '.%i.tmp' % threading.get_ident()
+        with open(entry_tmp, 'w') as fentry:
+            fentry.write(entry)
+        os.replace(entry_tmp, self.entry_path(key))
+
+        with self.lock:
+            self.size += len(entry) - self.entries.pop(key, 0)
+            self.entries[key] = len(entry)
+
+            while self.size > self.max_size and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                try:
+                    os.remove(self.entry_path(old_key))
+                except OSError:
+                    pass
+
+    def remove(self, key):
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+
+class HttpClient():
+    """
+    HTTP client with a pool of keep-alive connections and rate control
+
+    All the requests are sent using a pool of keep-alive connections so
+    the TCP+TLS handshake is only paid when a new connection is opened.
+    Requests are paced by a rate limiter and retried when throttled or
+    failed. The client can be shared between threads.
+    """
+
+    service = 'http'  # Name used in the metrics
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 limiter=None, max_retries=MAX_RETRIES):
+        """
+        :param pool_connections: number of hosts to keep connections pools for
+        :param pool_maxsize: max number of connections kept alive per host
+        :param limiter: rate limiter to use, the process shared one by default
+        :param max_retries: max number of retries for throttled (429) or failed (5xx) queries
+        """
+        self.pool_maxsize = pool_maxsize
+        self.limiter = limiter if limiter else get_limiter()
+        self.max_retries = max_retries
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                   pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def send(self, method, url, headers, data=None, idempotent=None, endpoint=None):
+        """
+        Send a request controlling the rate limit and retrying it if needed
+
+        If status code is 429, Retry-After header field has the seconds to wait.
+        Server errors (5xx) and connection errors are retried with exponential backoff
+        only for idempotent requests, as the server could have processed the failed one.
+
+        :param method: HTTP method
+        :param url: URL to send the request to
+        :param headers: HTTP headers for the request
+        :param data: body of the request
+        :param idempotent: if the request can be sent twice, by default only for IDEMPOTENT_METHODS
+        :param endpoint: name of the endpoint in the metrics, built from the URL path by default
+        :return: the last HTTP response received
+        """
+
+        attempt = 0
+        endpoint = endpoint if endpoint else endpoint_name(url)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        while True:
+            self.limiter.acquire()
+            task_init = time.time()
+            try:
+                res = self.session.request(method, url, headers=headers, data=data)
+            except requests.ConnectionError as ex:
+                METRICS.inc('http_errors_total', service=self.service, endpoint=endpoint)
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                print("Connection error in query to %s, retrying" % self.service, ex)
+                METRICS.inc('http_retries_total', service=self.service, endpoint=endpoint, reason='connection')
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            METRICS.observe('http_request_seconds', time.time() - task_init, service=self.service, endpoint=endpoint)
+            METRICS.inc('http_requests_total', service=self.service, endpoint=endpoint, status=res.status_code)
+            METRICS.inc('http_response_bytes_total', len(res.content), service=self.service, endpoint=endpoint)
+            if res.status_code == 429:
+                METRICS.inc('http_throttled_total', service=self.service, endpoint=endpoint)
+
+            if attempt >= self.max_retries:
+                break
+
+            if res.status_code == 429:
+                wait = retry_after_delay(res)
+                print("Rate limit exceeded in %s, waiting %0.1f sec" % (self.service, wait))
+                METRICS.inc('http_retries_total', service=self.service, endpoint=endpoint, reason='429')
+                self.limiter.pause(wait)
+            elif res.status_code >= 500 and idempotent:
+                print("Error %i in query to %s, retrying" % (res.status_code, self.service))
+                METRICS.inc('http_retries_total', service=self.service, endpoint=endpoint, reason='5xx')
+                time.sleep(backoff_delay(attempt))
+            else:
+                break
+
+            attempt += 1
+
+        return res
+
+    def stats(self):
+        """
+        Connections usage for the pools currently alive
+
+        :return: a dict with the number of requests sent, connections opened and connections reused
+        """
+
+        requests_sent = 0
+        connections_opened = 0
+
+        pools = self.adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:
+                # The pool has been discarded while iterating
+                continue
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+
+        return {
+            "requests": requests_sent,
+            "connections_opened": connections_opened,
+            "connections_reused": requests_sent - connections_opened
+        }
+
+    def export_pool_metrics(self):
+        """ Set the gauges with the connections pool stats of the client """
+
+        for stat, value in self.stats().items():
+            METRICS.set('http_pool_' + stat, value, service=self.service)
+
+    def close(self):
+        """ Close all the connections in the pool """
+        METRICS.remove_collector(self.export_pool_metrics)
+        self.session.close()
+
+
+class SpotifyClient(HttpClient):
+    """
+    HTTP client for the Spotify Web API
+
+    GET responses are stored in the cache, if any, and they are reused
+    while they are fresh or the server confirms they have not changed.
+    """
+
+    service = 'spotify'
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 limiter=None, max_retries=MAX_RETRIES, cache=None):
+        """
+        :param pool_connections: number of hosts to keep connections pools for
+        :param pool_maxsize: max number of connections kept alive per host
+        :param limiter: rate limiter to use, the process shared one by default
+        :param max_retries: max number of retries for throttled (429) or failed (5xx) queries
+        :param cache: ResponseCache for GET queries, None to disable caching
+        """
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                         limiter=limiter, max_retries=max_retries)
+        self.cache = cache
+        self.users = {}  # token -> user, to share cache entries between tokens
+
+    def query(self, token, url, method="GET", data=None):
+        """
+        Send a query to the Spotify API
+
+        :param token: Auth token
+        :param url: URL for the endpoint we want to access
+        :param method: HTTP method to use (GET or POST)
+        :param data: body to send in POST requests
+        :return: The result in json format
+        """
+
+        if method not in ["GET", "POST"]:
+            raise RuntimeError('Method %s not supported in queries to the Web API' % method)
+
+        headers = {"Authorization": "Bearer %s" % token}
+
+        # Use the cached response if it is fresh, or ask the server if it has changed
+        # https://developer.spotify.com/web-api/user-guide/#conditional-requests
+        cache = self.cache if method == "GET" else None
+        user = self.users.get(token, token)
+        entry = cache.get(url, user) if cache else None
+        if entry:
+            if entry['expires'] > time.time():
+                METRICS.inc('cache_lookups_total', cache=self.service, result='fresh')
+                return entry['body']
+            if entry['etag']:
+                headers["If-None-Match"] = entry['etag']
+
+        res = self.send(method, url, headers, data)
+
+        if res.status_code == 304 and entry:
+            METRICS.inc('cache_lookups_total', cache=self.service, result='revalidated')
+            expires = cache_expiration(res)
+            if expires:
+                cache.put(url, user, entry['etag'], expires, entry['body'])
+            return entry['body']
+        elif cache:
+            METRICS.inc('cache_lookups_total', cache=self.service, result='miss')
+
+        try:
+            res.raise_for_status()
+        except Exception:
+            print("Error in query to Web API", res.reason, res.text)
+            raise
+
+        body = res.json()
+
+        if cache:
+            expires = cache_expiration(res)
+            etag = res.headers.get('ETag')
+            if expires and (etag or expires > time.time()):
+                cache.put(url, user, etag, expires, body)
+
+        return body
+
+    def register_user(self, token, user):
+        """
+        Register the user owning a token so its cached responses are reused with new tokens
+
+        :param token: Auth token
+        :param user: Spotify user for the token
+        :return: None
+        """
+        self.users[token] = user
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Get the Spotify client shared by all the queries in the process
+
+    :return: the shared SpotifyClient
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SpotifyClient(cache=ResponseCache())
+                METRICS.add_collector(_client.export_pool_metrics)
+
+    return _client
+
+
+def configure_client(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                     cache_dir=CACHE_DIR, cache_max_size=CACHE_MAX_SIZE):
+    """
+    Replace the shared Spotify client with a new one using the pool and cache config
+
+    :param pool_connections: number of hosts to keep connections pools for
+    :param pool_maxsize: max number of connections kept alive per host
+    :param cache_dir: directory for the responses cache, None to disable it
+    :param cache_max_size: max bytes used by the responses cache
+    :return: the new shared SpotifyClient
+    """
+    global _client
+
+    cache = ResponseCache(cache_dir, cache_max_size) if cache_dir else None
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = SpotifyClient(pool_connections=pool_connections, pool_maxsize=pool_maxsize, cache=cache)
+        METRICS.add_collector(_client.export_pool_metrics)
+
+    return _client
 
 
 def query_api(token, url, method="GET", data=None):
     """
-    Send a query to the Spotiy API
+    Send a query to the Spotiy API using the shared client
 
     :param token: Auth token
     :param url: URL for the endpoint we want to access
+    :param method: HTTP method to use (GET or POST)
+    :param data: body to send in POST requests
     :return: The result in json format
     """
 
-    # TODO: Control rate limit
-    # If status code is 429, Retry-After header field has the seconds to wait
-    # Somewhere around 10-20 requests per second would put you in the correct ballpark
-    # TODO: Use cache field to avoid querying the API
-    # https://developer.spotify.com/web-api/user-guide/#conditional-requests
+    return get_client().query(token, url, method, data)
 
-    headers = {"Authorization": "Bearer %s" % token}
-    if method == "GET":
-        res = requests.get(url, headers=headers)
-    elif method == "POST":
-        res = requests.post(url, headers=headers, data=data)
-    try:
-        res.raise_for_status()
-    except Exception:
-        print("Error in query to Web API", res.reason, res.text)
-        raise
 
-    return res.json()
+def paginate(token, url, limit=50, max_items=0, key=None, workers=PAGINATION_WORKERS):
+    """
+    Get the items from an endpoint paginated with limit+offset
+
+    The first page is fetched to know the total number of items, and
+    then the rest of the pages are fetched in parallel.
+
+    :param token: Auth token
+    :param url: URL for the endpoint, without limit and offset params
+    :param limit: number of items per page
+    :param max_items: max number of items to return, 0 for all of them
+    :param key: field in the response with the paging object (i.e. 'tracks' in search), None if it is the response
+    :param workers: max number of pages fetched at the same time
+    :return: the items list in the order returned by the endpoint
+    """
+
+    if max_items and limit > max_items:
+        limit = max_items
+
+    def fetch_page(offset):
+        res = query_api(token, build_page_url(url, limit, offset))
+        return res[key] if key else res
+
+    page = fetch_page(0)
+    items = page['items']
+
+    total = page.get('total', len(items))
+    if max_items:
+        total = min(total, max_items)
+
+    offsets = range(len(items), total, limit) if items else []
+    if offsets:
+        with ThreadPoolExecutor(max_workers=min(workers, len(offsets))) as executor:
+            # map returns the pages in the same order than the offsets
+            for page in executor.map(fetch_page, offsets):
+                if not page['items']:
+                    break
+                items += page['items']
+
+    if max_items:
+        items = items[:max_items]
+
+    return items
+
+
+def iter_pages(token, url, limit=50, max_items=0, key=None, prefetch=PREFETCH_PAGES):
+    """
+    Iterate the items from an endpoint paginated with limit+offset
+
+    The items are returned as soon as their page arrives, and the next
+    pages are fetched in background while the current one is consumed.
+
+    :param token: Auth token
+    :param url: URL for the endpoint, without limit and offset params
+    :param limit: number of items per page
+    :param max_items: max number of items to return, 0 for all of them
+    :param key: field in the response with the paging object (i.e. 'tracks' in search), None if it is the response
+    :param prefetch: number of pages fetched in background
+    :return: a generator of items in the order returned by the endpoint
+    """
+
+    if max_items and limit > max_items:
+        limit = max_items
+
+    def fetch_page(offset):
+        res = query_api(token, build_page_url(url, limit, offset))
+        return res[key] if key else res
+
+    page = fetch_page(0)
+
+    total = page.get('total', len(page['items']))
+    if max_items:
+        total = min(total, max_items)
+
+    offsets = iter(range(len(page['items']), total, limit) if page['items'] else [])
+    items_returned = 0
+
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque([executor.submit(fetch_page, offset) for offset in itertools.islice(offsets, prefetch)])
+        try:
+            while True:
+                for item in page['items']:
+                    if max_items and items_returned >= max_items:
+                        return
+                    yield item
+                    items_returned += 1
+
+                if not pending:
+                    break
+                page = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch_page, offset))
+                if not page['items']:
+                    break
+        finally:
+            # Don't wait for the pages not needed anymore
+            for future in pending:
+                future.cancel()
+
+
+def build_page_url(url, limit, offset):
+    """
+    Add the pagination params to an endpoint URL
+
+    :param url: URL for the endpoint
+    :param limit: number of items per page
+    :param offset: offset of the first item in the page
+    :return: the URL for the page
+    """
+
+    return url + ("&" if "?" in url else "?") + "limit=%i&offset=%i" % (limit, offset)
+
+
+_profiles = {}  # token -> (profile, fetch time)
+_profiles_lock = threading.Lock()
 
 
 def find_user_profile(token):
     """
     Find the user profile
 
+    The profile is fetched once per token and reused during PROFILE_TTL seconds.
+
     :param token: Auth token
     :return: the user profile related to the auth token
     """
 
+    with _profiles_lock:
+        if token in _profiles:
+            profile, fetched = _profiles[token]
+            if time.time() - fetched < PROFILE_TTL:
+                return profile
+
     profile = query_api(token, SPOTIFY_API_ME)
 
+    with _profiles_lock:
+        # Remove the profiles from the old tokens before adding the new one
+        now = time.time()
+        for old_token in [old_token for old_token, (_, fetched) in _profiles.items() if now - fetched >= PROFILE_TTL]:
+            del _profiles[old_token]
+        _profiles[token] = (profile, now)
+
     return profile
 
 
+def build_playlist_url(playlist_id, user_id=None):
+    """
+    Build the URL for a playlist
+
+    :param playlist_id: playlist id
+    :param user_id: owner of the playlist, if None the /playlists route is used
+    :return: the URL for the playlist endpoint
+    """
+
+    if user_id:
+        return SPOTIFY_API + "/users/%s/playlists/%s" % (user_id, playlist_id)
+
+    return SPOTIFY_API + "/playlists/%s" % playlist_id
+
+
 def find_user_tops(token, kind='tracks'):
     """
     Find the top tracks or artists
@@ -149,45 +957,93 @@ def find_user_followed_artists(token):
     :return: An artists list
     """
 
-    artists = []
-    after = ''
+    return list(iter_user_followed_artists(token))
 
-    limit = 50
 
-    while True:
-        time.sleep(0.1)
+def iter_user_followed_artists(token):
+    """
+    Iterate the artists a user is following
 
+    The pages are linked with a cursor, so the next page is fetched in
+    background once the current one has arrived.
+
+    :param token: Auth token
+    :return: a generator of artists
+    """
+
+    limit = 50
+
+    def fetch_page(after):
         followed_url = SPOTIFY_API_ME + "/following?type=artist&limit=%i" % limit
         if after:
             followed_url += "&after=" + after
-        items = query_api(token, followed_url)
+        return query_api(token, followed_url)['artists']
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = fetch_page('')
+        while True:
+            after = page['cursors']['after']
+            next_page = executor.submit(fetch_page, after) if after else None
+            try:
+                for artist in page['items']:
+                    yield artist
+            except GeneratorExit:
+                # Don't wait for the page not needed anymore
+                if next_page:
+                    next_page.cancel()
+                raise
+            if not next_page:
+                break
+            page = next_page.result()
+
+
+def fetch_items_from_ids(token, kind, items_ids, max_ids):
+    """
+    Fetch items using the Spotify endpoints for getting several items in a call
+
+    The ids are sent in chunks of max_ids, so len(items_ids)/max_ids calls are done.
+
+    :param token: Auth token
+    :param kind: kind of the items (tracks, artists ...) used as endpoint in the API
+    :param items_ids: list of items ids
+    :param max_ids: max number of ids supported by the endpoint in a call
+    :return: an items list in the same order than items_ids, with None for the items not found
+    """
 
-        artists += items['artists']['items']
-        after = items['artists']['cursors']['after']
-        if not after:
-            break
+    items = []
+    items_ids = list(items_ids)
 
-    return artists
+    for offset in range(0, len(items_ids), max_ids):
+        items_url = SPOTIFY_API + "/%s?ids=%s" % (kind, ",".join(items_ids[offset:offset + max_ids]))
+        res = query_api(token, items_url)
+        items += res[kind]
 
+    return items
 
-def fetch_playlists_from_ids(token, playlists_ids):
+
+def fetch_playlists_from_ids(token, playlists_ids, user_id=None):
     """
     Fetch the playlists information given their ids and the user auth token
 
+    There is no endpoint in the API to get several playlists in a call,
+    so a call per playlist is done.
+
     :param token: Auth token
     :param playlists_ids: list of playlists ids
-    :return: a playlist list
+    :param user_id: owner of the playlists, not needed to access them
+    :return: a playlist list in the same order than playlists_ids, with None for the playlists not found
     """
 
     playlists = []
 
-    # First we need the user_id
-
-    user_id = find_user_profile(token)['id']
-
     for playlist_id in playlists_ids:
-        playlist_url = SPOTIFY_API  + "/users/%s/playlists/%s" % (user_id, playlist_id)
-        res = query_api(token, playlist_url)
+        playlist_url = build_playlist_url(playlist_id, user_id)
+        try:
+            res = query_api(token, playlist_url)
+        except requests.HTTPError as ex:
+            if ex.response is None or ex.response.status_code != 404:
+                raise
+            res = None
         playlists.append(res)
 
     return playlists
@@ -202,28 +1058,32 @@ def find_user_playlists(token, max=0):
     :return: All the user playlists
     """
 
-    playlists = []
-
-    limit = 50
-    offset = 0
     max_playlists = 1000  # safe limit
     if max:
         max_playlists = max
-        if limit > max:
-            limit = max
 
-    while offset < max_playlists:
-        playlists_url = SPOTIFY_API_ME + "/playlists?limit=%i&offset=%i" % (limit, offset)
-        res = query_api(token, playlists_url)
-        if not res['items']:
-            break
-        playlists += res['items']
-        offset += limit
+    playlists = paginate(token, SPOTIFY_API_ME + "/playlists", limit=50, max_items=max_playlists)
 
     return playlists
 
 
-def find_user_playlist_tracks(token, playlist=None, playlist_id=None, max=0):
+def iter_user_playlists(token, max=0):
+    """
+    Iterate the playlists from the current user as they are fetched
+
+    :param token: Auth token
+    :param max: max number of playlists to return
+    :return: a generator of playlists
+    """
+
+    max_playlists = 1000  # safe limit
+    if max:
+        max_playlists = max
+
+    return iter_pages(token, SPOTIFY_API_ME + "/playlists", limit=50, max_items=max_playlists)
+
+
+def find_user_playlist_tracks(token, playlist=None, playlist_id=None, max=0, user_id=None):
     """
     Find all the tracks included in a playlist
 
@@ -231,12 +1091,9 @@ def find_user_playlist_tracks(token, playlist=None, playlist_id=None, max=0):
     :param playlist: playlist spotify object from which to get the tracks
     :param playlist_id: playlist id from which to get the tracks
     :param max: max number of tracks to return
+    :param user_id: owner of the playlist, not needed to access it
     :return: All the playlist tracks
     """
-    tracks = []
-
-    limit = 50
-    offset = 0
     max_tracks = 1000  # safe limit
     if max:
         max_tracks = max
@@ -244,19 +1101,35 @@ def find_user_playlist_tracks(token, playlist=None, playlist_id=None, max=0):
     if not playlist_id:
         playlist_id = playlist['id']
 
-    # First we need the user_id
+    tracks_url = build_playlist_url(playlist_id, user_id) + "/tracks"
+    tracks = paginate(token, tracks_url, limit=50, max_items=max_tracks)
 
-    user_id = find_user_profile(token)['id']
+    return tracks
 
-    while offset < max_tracks:
-        tracks_url = SPOTIFY_API  + "/users/%s/playlists/%s/tracks?limit=%i&offset=%i" % (user_id, playlist_id, limit, offset)
-        res = query_api(token, tracks_url)
-        if not res['items']:
-            break
-        tracks += res['items']
-        offset += limit
 
-    return tracks
+def iter_user_playlist_tracks(token, playlist=None, playlist_id=None, max=0, user_id=None):
+    """
+    Iterate the tracks included in a playlist as they are fetched
+
+    :param token: Auth token
+    :param playlist: playlist spotify object from which to get the tracks
+    :param playlist_id: playlist id from which to get the tracks
+    :param max: max number of tracks to return
+    :param user_id: owner of the playlist, not needed to access it
+    :return: a generator of playlist tracks
+    """
+
+    max_tracks = 1000  # safe limit
+    if max:
+        max_tracks = max
+
+    if not playlist_id:
+        playlist_id = playlist['id']
+
+    tracks_url = build_playlist_url(playlist_id, user_id) + "/tracks"
+
+    return iter_pages(token, tracks_url, limit=50, max_items=max_tracks)
+
 
 def fetch_tracks_from_ids(token, tracks_ids):
     """
@@ -264,15 +1137,19 @@ def fetch_tracks_from_ids(token, tracks_ids):
 
     :param token: Auth token
     :param tracks_ids: list of track ids
-    :return: a tracks list
+    :return: a tracks list in the same order than tracks_ids, with None for the tracks not found
     """
 
-    tracks = []
+    return fetch_items_from_ids(token, 'tracks', tracks_ids, MAX_IDS_TRACKS)
 
 
-    for track_id in tracks_ids:
-        track_url = SPOTIFY_API  + "/tracks/%s" % (track_id)
-        res = query_api(token, track_url)
-        tracks.append(res)
+def fetch_artists_from_ids(token, artists_ids):
+    """
+    Fetch the artists information given their ids and the user auth token
 
-    return tracks
+    :param token: Auth token
+    :param artists_ids: list of artist ids
+    :return: an artists list in the same order than artists_ids, with None for the artists not found
+    """
+
+    return fetch_items_from_ids(token, 'artists', artists_ids, MAX_IDS_ARTISTS)
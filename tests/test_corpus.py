@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the streaming of songs files
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+import json
+import os
+import tempfile
+import unittest
+
+from spoting.corpus import iter_json_array, iter_songs
+
+
+class TestIterJsonArray(unittest.TestCase):
+    """ Items split between the chunks read from the file must be decoded complete """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, text, name='songs.json'):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'w', encoding='utf-8') as fjson:
+            fjson.write(text)
+        return path
+
+    def check_all_chunk_sizes(self, text):
+        path = self.write(text)
+        expected = json.loads(text)
+        for chunk_size in range(1, len(text) + 2):
+            self.assertEqual(list(iter_json_array(path, chunk_size=chunk_size)), expected,
+                             "chunk_size=%i" % chunk_size)
+
+    def test_numbers_split(self):
+        self.check_all_chunk_sizes('[1, 23456, 7]')
+        self.check_all_chunk_sizes('[12.5, -3e10,0.25,1E-3]')
+
+    def test_literals_split(self):
+        self.check_all_chunk_sizes('[true,false, null , 100]')
+
+    def test_strings_and_objects_split(self):
+        self.check_all_chunk_sizes('[{"id": 1, "title": "a, ] b", "lyrics": "x\\"y"}, "z]", [1, [2]], {}]')
+
+    def test_empty_array(self):
+        self.check_all_chunk_sizes('[]')
+        self.check_all_chunk_sizes(' [ \n ] ')
+
+    def test_truncated_array(self):
+        path = self.write('[1, 2')
+        with self.assertRaises(ValueError):
+            list(iter_json_array(path, chunk_size=2))
+
+    def test_not_an_array(self):
+        path = self.write('{"id": 1}')
+        with self.assertRaises(ValueError):
+            list(iter_json_array(path))
+
+    def test_iter_songs_fields(self):
+        songs = [{"id": pos, "title": "song %i" % pos, "lyrics": "la " * pos} for pos in range(50)]
+        path = self.write(json.dumps(songs))
+        self.assertEqual(list(iter_songs(path, fields=['id', 'title'])),
+                         [{"id": song['id'], "title": song['title']} for song in songs])
+
+        path = self.write("\n".join(json.dumps(song) for song in songs) + "\n", name='songs.jsonl')
+        self.assertEqual(list(iter_songs(path)), songs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the detection of duplicated songs titles
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+import unittest
+
+from spoting.genius import TitlesDeduplicator, normalize_title
+
+# Versions of a song which must share the normalized title with it
+SAME_SONG = [
+    ("Yesterday", "Yesterday (Remastered 2009)"),
+    ("Yesterday", "Yesterday - 2009 Remaster"),
+    ("Yesterday", "Yesterday - Remastered"),
+    ("Yesterday", "Yesterday [Live]"),
+    ("Yesterday", "Yesterday - Live at Shea Stadium"),
+    ("Yesterday", "Yesterday (Demo)"),
+    ("Yesterday", "Yesterday (Acoustic Version)"),
+    ("Yesterday", "Yesterday (Radio Edit)"),
+    ("Yesterday", "Yesterday (Mono)"),
+    ("Yesterday", "Yesterday (Extended Mix)"),
+    ("Yesterday", "Yesterday [Club Remix]"),
+    ("Yesterday", "Yesterday (feat. Someone)"),
+    ("Yesterday", "Yesterday (Live) [Remastered 2009]"),
+    ("Canción", "CANCION (Live)"),
+]
+
+# Titles with a suffix which is part of the name of a different song
+DIFFERENT_SONGS = [
+    ("Country Roads", "Country Roads (Take Me Home)"),
+    ("Intro", "Intro (Radio Silence)"),
+    ("Heroes", "Heroes (Remember the Name)"),
+    ("Love", "Love - The Session Singer"),
+    ("Live", "Live (Forever)"),
+    ("Version", "Version (Mix Tape)"),
+    ("Song", "Song (Take 2)"),
+]
+
+
+class TestNormalizeTitle(unittest.TestCase):
+    """ Only the known version suffixes are removed from the titles """
+
+    def test_same_song(self):
+        for title, version in SAME_SONG:
+            with self.subTest(version=version):
+                self.assertEqual(normalize_title(title), normalize_title(version))
+
+    def test_different_songs(self):
+        for title, other in DIFFERENT_SONGS:
+            with self.subTest(other=other):
+                self.assertNotEqual(normalize_title(title), normalize_title(other))
+
+    def test_only_suffix(self):
+        self.assertEqual(normalize_title("(Live)"), "live")
+
+    def test_deduplicator(self):
+        dedup = TitlesDeduplicator()
+        seen = [title for title, _ in DIFFERENT_SONGS] + [other for _, other in DIFFERENT_SONGS]
+
+        self.assertEqual([dedup.is_duplicated(title) for title in seen], [False] * len(seen))
+        self.assertTrue(dedup.is_duplicated("Country Roads (Live)"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the refresh of the Spotify tokens
+#
+# Copyright (C) Alvaro del Castillo
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+from spoting import spoting
+from spoting.spoting import TOKEN_REFRESH_MARGIN, TokenManager
+
+
+class StubOAuth():
+    """ SpotifyOAuth which keeps returning the cached token until it is refreshed """
+
+    def __init__(self, token_info):
+        self.token_info = token_info
+        self.refreshed = 0
+
+    def get_cached_token(self):
+        return self.token_info
+
+    def refresh_access_token(self, refresh_token):
+        self.refreshed += 1
+        self.token_info = {
+            'access_token': 'new-token',
+            'refresh_token': refresh_token,
+            'expires_at': int(time.time()) + 3600
+        }
+        return self.token_info
+
+
+class TestTokenManager(unittest.TestCase):
+    """ Tokens close to expire must be really refreshed and keep the expiry from Spotify """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.token_file = os.path.join(self.tmp_dir.name, '.token')
+        patcher = mock.patch.object(spoting, 'get_client')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_refresh_old_token(self):
+        expires_at = int(time.time()) + TOKEN_REFRESH_MARGIN - 60
+        oauth = StubOAuth({'access_token': 'old-token', 'refresh_token': 'refresh', 'expires_at': expires_at})
+        manager = TokenManager('user', 'scope', token_file=self.token_file, oauth=oauth)
+
+        manager.refresh()
+
+        self.assertEqual(oauth.refreshed, 1)
+        self.assertEqual(manager.current, ('new-token', oauth.token_info['expires_at']))
+        with open(self.token_file) as ftoken:
+            self.assertEqual(json.load(ftoken), {'access_token': 'new-token', 'expires_at': oauth.token_info['expires_at']})
+
+    def test_expiring_token_is_not_fresh(self):
+        expires_at = int(time.time()) + TOKEN_REFRESH_MARGIN - 60
+        oauth = StubOAuth({'access_token': 'old-token', 'refresh_token': 'refresh', 'expires_at': expires_at})
+        manager = TokenManager('user', 'scope', token_file=self.token_file, oauth=oauth)
+        manager.set_token('old-token', expires_at)
+
+        # The old token is still valid so it is returned while the new one is got in background
+        self.assertEqual(manager.get(), 'old-token')
+        manager.refresh_lock.acquire()
+        manager.refresh_lock.release()
+
+        self.assertEqual(oauth.refreshed, 1)
+        self.assertEqual(manager.get(), 'new-token')
+
+    def test_load_expiring_token_file(self):
+        expires_at = int(time.time()) + TOKEN_REFRESH_MARGIN - 60
+        with open(self.token_file, 'w') as ftoken:
+            json.dump({'access_token': 'old-token', 'expires_at': expires_at}, ftoken)
+        manager = TokenManager('user', 'scope', token_file=self.token_file, oauth=StubOAuth(None))
+
+        self.assertFalse(manager.load())
+
+
+if __name__ == '__main__':
+    unittest.main()
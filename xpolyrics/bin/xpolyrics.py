@@ -23,10 +23,11 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import requests
+import logging
 
+from spoting.metrics import flush_at_exit
 from spoting.spoting import collect_tokens, find_user_playlists, find_user_playlist_tracks
-from spoting.genius import build_genius_token, embed_lyrics, find_genius_lyrics, scrap_lyrics
+from spoting.genius import build_genius_token, find_genius_lyrics, scrap_lyrics
 
 # SPOTIFY config
 SPOTIFY_USER = 'acsspotify'
@@ -40,6 +41,9 @@ MAX_TRACKS = 50
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    flush_at_exit()
+
     # The first step is to get the list of Play Lists from Spotify
     token = collect_tokens(SPOTIFY_USER, SCOPES)
 
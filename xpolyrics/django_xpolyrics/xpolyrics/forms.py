@@ -4,6 +4,8 @@ from time import time
 
 from django import forms
 
+from spoting.metrics import METRICS
+
 from . import data
 
 SELECT_LINES = 20
@@ -15,8 +17,10 @@ def perfdata(func):
     def decorator(self, *args, **kwargs):
         task_init = time()
         data = func(self, *args, **kwargs)
+        elapsed = time() - task_init
+        METRICS.observe('xpolyrics_form_seconds', elapsed, form=self.__class__.__name__)
         print("%s: Total data collecting time ... %0.3f sec" %
-              (self.__class__.__name__, time() - task_init))
+              (self.__class__.__name__, elapsed))
         return data
     return decorator
 
@@ -5,5 +5,6 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('select_playlist', views.PlaylistView.select_playlist),
-    path('select_track', views.TrackView.select_track)
+    path('select_track', views.TrackView.select_track),
+    path('metrics', views.metrics)
 ]
\ No newline at end of file
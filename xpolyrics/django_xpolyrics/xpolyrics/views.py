@@ -12,6 +12,7 @@ from django.template import loader
 
 from spoting.spoting import collect_tokens
 from spoting.genius import embed_lyrics
+from spoting.metrics import METRICS, PrometheusSink
 
 from . import forms
 from . import data
@@ -32,7 +33,9 @@ def perfdata(func):
     def decorator(*args, **kwargs):
         task_init = time()
         data = func(*args, **kwargs)
-        print("%s: %0.3f sec" % (func, time() - task_init))
+        elapsed = time() - task_init
+        METRICS.observe('xpolyrics_view_seconds', elapsed, view=func.__qualname__)
+        print("%s: %0.3f sec" % (func, elapsed))
         return data
     return decorator
 
@@ -101,6 +104,12 @@ def select_playlist(request):
 
 
 
+def metrics(request):
+    """ Export the metrics in Prometheus text format """
+
+    return HttpResponse(PrometheusSink().render(METRICS), content_type='text/plain; version=0.0.4')
+
+
 def return_error(message):
 
     template = loader.get_template('xpolyrics/error.html')